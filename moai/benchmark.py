@@ -0,0 +1,78 @@
+"""Compare the cost of mapping labman rows to metadata dicts with the
+JSON string building that was used before. Run with:
+
+  python -m moai.benchmark [rounds]
+"""
+import re
+import sys
+import json
+import timeit
+
+from moai.database import SQLDatabase
+from moai.fixtures import fill_labman_database
+
+
+def process_control_char_word_break(text):
+    # the old escaping, kept here as the baseline
+    p = re.compile(ur'-\n', re.UNICODE)
+    processed_text = re.sub(p, u'', text)
+    processed_text = processed_text.replace('\\', '\\\\')
+    processed_text = processed_text.replace('\n', ' ')
+    processed_text = processed_text.replace('\"', '\\"')
+    processed_text = processed_text.replace('\r', '')
+    processed_text = processed_text.replace('\t', '')
+    processed_text = processed_text.replace('\b', '')
+    processed_text = processed_text.replace('\f', '')
+    return processed_text
+
+def string_pubmetadata(record, related):
+    # the old string builder, followed by the json.loads oai_query did
+    metadata = '{"title":["' + process_control_char_word_break(record.title) + '"], ' \
+      '"date":["' + record.published.strftime('%Y-%m-%dT%H:%M:%SZ') + '"]' \
+      ', "format":["digital"], "type":["' + record.child_type + '"]'
+    parent = related['parents'].get(record.id)
+    if parent is not None and parent.publisher is not None:
+        metadata += ', "publisher":["' + parent.publisher + '"]'
+    if record.abstract is not None:
+        metadata += ', "description":["' + process_control_char_word_break(record.abstract) + '"]'
+    if record.language_id is not None:
+        language_tag = related['languages'].get(record.language_id)
+        if language_tag is not None:
+            metadata += ', "language":["' + language_tag + '"]'
+    else:
+        metadata += ', "language":["en"]'
+    creators = related['authors'].get(record.id)
+    if creators:
+        metadata += ', "creator":["' + '", "'.join(creators) + '"]'
+    subjects = related['tags'].get(record.id)
+    if subjects:
+        metadata += ', "subject":["' + '", "'.join(subjects) + '"]'
+    return json.loads(metadata + '}')
+
+def main():
+    rounds = 10000
+    if len(sys.argv) > 1:
+        rounds = int(sys.argv[1])
+    db = SQLDatabase()
+    fill_labman_database(db)
+    records = db._publication.select().execute().fetchall()
+    related = db.get_publications_related(records)
+    for record in records:
+        assert string_pubmetadata(record, related) == db.map_publication(
+            record, related)
+
+    def string_path():
+        for record in records:
+            string_pubmetadata(record, related)
+
+    def dict_path():
+        for record in records:
+            db.map_publication(record, related)
+
+    count = rounds * len(records)
+    for name, path in [('json string', string_path), ('dict', dict_path)]:
+        seconds = min(timeit.repeat(path, repeat=3, number=rounds))
+        print '%-12s %8.2f us per record' % (name, seconds / count * 1e6)
+
+if __name__ == '__main__':
+    main()
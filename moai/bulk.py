@@ -0,0 +1,122 @@
+import datetime
+from cStringIO import StringIO
+
+import sqlalchemy as sql
+
+
+class BulkWriter(object):
+    """Write batches of rows to a table, replacing the rows that have the
+    same primary key. This version deletes the keys of the batch and
+    inserts the rows, which works on every database; the cost only
+    depends on the size of the batch.
+    """
+
+    chunk_size = 500
+
+    def __init__(self, dialect):
+        self.dialect = dialect
+
+    def delete(self, connection, column, keys):
+        """Delete the rows that have one of keys in column."""
+        keys = list(keys)
+        for start in xrange(0, len(keys), self.chunk_size):
+            connection.execute(column.table.delete(
+                column.in_(keys[start:start + self.chunk_size])))
+
+    def upsert(self, connection, table, rows):
+        """Insert rows, replacing the rows with the same primary key."""
+        if not rows:
+            return
+        key_columns = list(table.primary_key.columns)
+        if len(key_columns) == 1:
+            self.delete(connection, key_columns[0],
+                        [row[key_columns[0].name] for row in rows])
+        else:
+            connection.execute(table.delete(sql.and_(
+                *[column == sql.bindparam(column.name)
+                  for column in key_columns])),
+                [dict([(column.name, row[column.name])
+                       for column in key_columns]) for row in rows])
+        connection.execute(table.insert(), rows)
+
+    def replace(self, connection, column, keys, rows):
+        """Replace all rows that have one of keys in column with rows."""
+        self.delete(connection, column, keys)
+        if rows:
+            connection.execute(column.table.insert(), rows)
+
+
+class SQLiteBulkWriter(BulkWriter):
+    """Upserts with one INSERT OR REPLACE statement."""
+
+    def upsert(self, connection, table, rows):
+        if rows:
+            connection.execute(table.insert().prefix_with('OR REPLACE'), rows)
+
+
+class PostgresBulkWriter(BulkWriter):
+    """Upserts by COPYing the rows into a temporary staging table, which
+    is merged into the table with INSERT ... ON CONFLICT DO UPDATE.
+    Needs psycopg2 and PostgreSQL 9.5 or newer.
+    """
+
+    def copy_field(self, value):
+        # every value is quoted, so only None is written as an unquoted
+        # empty field, which COPY reads as NULL
+        if value is None:
+            return ''
+        if isinstance(value, unicode):
+            value = value.encode('utf8')
+        elif isinstance(value, (datetime.datetime, datetime.date)):
+            value = value.isoformat()
+        else:
+            value = str(value)
+        return '"%s"' % value.replace('"', '""')
+
+    def upsert(self, connection, table, rows):
+        if not rows:
+            return
+        quote = self.dialect.identifier_preparer.quote
+        columns = [column.name for column in table.columns]
+        keys = [column.name for column in table.primary_key.columns]
+        target = quote(table.name)
+        staging = quote('moai_staging_%s' % table.name)
+        column_list = ', '.join([quote(column) for column in columns])
+
+        data = StringIO()
+        for row in rows:
+            data.write(','.join([self.copy_field(row.get(column))
+                                 for column in columns]) + '\n')
+        data.seek(0)
+
+        connection.execute('CREATE TEMPORARY TABLE %s (LIKE %s)' % (
+            staging, target))
+        cursor = connection.connection.cursor()
+        try:
+            cursor.copy_expert('COPY %s (%s) FROM STDIN WITH CSV' % (
+                staging, column_list), data)
+        finally:
+            cursor.close()
+        updates = ', '.join(['%s = EXCLUDED.%s' % (quote(column),
+                                                   quote(column))
+                             for column in columns if column not in keys])
+        if updates:
+            action = 'UPDATE SET %s' % updates
+        else:
+            action = 'NOTHING'
+        connection.execute(
+            'INSERT INTO %s (%s) SELECT %s FROM %s ON CONFLICT (%s) DO %s' % (
+                target, column_list, column_list, staging,
+                ', '.join([quote(key) for key in keys]), action))
+        connection.execute('DROP TABLE %s' % staging)
+
+
+def get_bulk_writer(connection):
+    """Return the BulkWriter for the database of connection."""
+    dialect = connection.dialect
+    if dialect.name == 'sqlite':
+        return SQLiteBulkWriter(dialect)
+    if (dialect.name == 'postgresql' and dialect.driver == 'psycopg2' and
+        (dialect.server_version_info or (0,)) >= (9, 5)):
+        return PostgresBulkWriter(dialect)
+    return BulkWriter(dialect)
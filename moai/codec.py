@@ -0,0 +1,131 @@
+import json
+import zlib
+import base64
+import cPickle
+from cStringIO import StringIO
+import datetime
+import collections
+
+
+def date_handler(obj):
+    if hasattr(obj, 'isoformat'):
+        return obj.isoformat()
+    else:
+        raise TypeError, 'Object of type %s with value of %s is not JSON serializable' % (type(obj), repr(obj))
+
+
+class JSONCodec(object):
+    """Metadata as JSON text, the format rows without a codec name have."""
+
+    name = 'json'
+
+    def encode(self, metadata):
+        return json.dumps(metadata, default=date_handler)
+
+    def decode(self, data):
+        return json.loads(data)
+
+
+class ZlibCodec(JSONCodec):
+    """zlib compressed JSON, base64 encoded to fit in a text column."""
+
+    name = 'zlib'
+
+    def encode(self, metadata):
+        return base64.b64encode(zlib.compress(
+            JSONCodec.encode(self, metadata)))
+
+    def decode(self, data):
+        return JSONCodec.decode(self, zlib.decompress(base64.b64decode(data)))
+
+
+class PickleCodec(object):
+    """zlib compressed pickle protocol 2, base64 encoded. It takes a little
+    more space than zlib compressed JSON but decodes faster. The protocol
+    is stable across Python versions. Dates are stored as their isoformat and strings,
+    including dict keys, as unicode, so the metadata decodes as it does
+    with JSON. Decoding does not look up any globals, so the data can
+    only build plain values."""
+
+    name = 'pickle'
+    protocol = 2
+
+    def plain(self, value):
+        if isinstance(value, dict):
+            return dict([(self.plain(key), self.plain(item))
+                         for key, item in value.items()])
+        if isinstance(value, (list, tuple)):
+            return [self.plain(item) for item in value]
+        if isinstance(value, (datetime.datetime, datetime.date)):
+            return unicode(value.isoformat())
+        if isinstance(value, str):
+            return value.decode('utf8')
+        return value
+
+    def encode(self, metadata):
+        return base64.b64encode(zlib.compress(
+            cPickle.dumps(self.plain(metadata), self.protocol)))
+
+    def decode(self, data):
+        unpickler = cPickle.Unpickler(StringIO(
+            zlib.decompress(base64.b64decode(data))))
+        unpickler.find_global = None
+        return unpickler.load()
+
+
+codecs = dict([(codec.name, codec)
+               for codec in [JSONCodec(), ZlibCodec(), PickleCodec()]])
+
+
+def get_codec(name):
+    if name not in codecs:
+        raise ValueError('No such metadata codec: %s' % name)
+    return codecs[name]
+
+def encode_metadata(metadata, name='json'):
+    """Encode a metadata dict with the named codec. Apart from JSON, the
+    data starts with the name of the codec, so every row can be decoded
+    whatever codec is configured when it is read. Small metadata does
+    not compress, it is stored as JSON when that is shorter."""
+    data = get_codec(name).encode(metadata)
+    if name == 'json':
+        return data
+    data = '%s:%s' % (name, data)
+    plain = codecs['json'].encode(metadata)
+    if len(plain) <= len(data):
+        return plain
+    return data
+
+def decode_metadata(data):
+    # JSON metadata starts with {, so it never looks like a codec name
+    name, separator, encoded = data.partition(':')
+    if separator and name in codecs and name != 'json':
+        return codecs[name].decode(encoded)
+    return codecs['json'].decode(data)
+
+
+class LazyMetadata(collections.Mapping):
+    """Read-only metadata of a record that is decoded when it is first
+    used, so listings that only need headers do not decode it."""
+
+    def __init__(self, data):
+        self._data = data
+        self._metadata = None
+
+    def decoded(self):
+        if self._metadata is None:
+            self._metadata = decode_metadata(self._data)
+            self._data = None
+        return self._metadata
+
+    def __getitem__(self, key):
+        return self.decoded()[key]
+
+    def __iter__(self):
+        return iter(self.decoded())
+
+    def __len__(self):
+        return len(self.decoded())
+
+    def __repr__(self):
+        return repr(self.decoded())
@@ -1,10 +1,14 @@
 import datetime
-import json
+import threading
 from pkg_resources import iter_entry_points
 
 import sqlalchemy as sql
 
-from moai.utils import check_type
+from moai.utils import check_type, IdentifierFilter
+from moai.replication import get_replica_router
+from moai.histogram import day_of, count_window
+from moai.bulk import get_bulk_writer
+from moai.codec import get_codec, encode_metadata, LazyMetadata
 
 def get_database(uri, config=None):
     prefix = uri.split(':')[0]
@@ -24,13 +28,126 @@ class SQLDatabase(object):
     more documentation.
     """
 
-    def __init__(self, dburi=None):
+    # number of partitions queried side by side
+    query_threads = 2
+
+    def __init__(self, dburi=None, config=None):
+        config = config or {}
         self._uri = dburi
+        self._codec = get_codec(config.get('metadata_codec', 'json')).name
+        self._partitionBy = config.get('partition_by') or None
+        if self._partitionBy not in (None, 'month'):
+            raise ValueError('Can not partition records by: %s' %
+                             self._partitionBy)
         self._db = self._connect()
         self._records = self._db.tables['records']
         self._sets = self._db.tables['sets']
         self._setrefs = self._db.tables['setrefs']
+        self._dayCounts = self._db.tables['day_counts']
+        self._partitions = self._db.tables['record_partitions']
+        self._writeMarks = self._db.tables['write_marks']
+        self._partitionLock = threading.Lock()
         self._reset_cache()
+        self._identifiers = (None, None)
+        self._local = threading.local()
+        self._router = get_replica_router(self._db.bind, config,
+                                          self.get_replication_position)
+        self._queryThreads = int(config.get('query_threads',
+                                            self.query_threads))
+
+    def get_replication_position(self, connectable):
+        # the time of the last write, a replica that missed writes is
+        # behind by the time between its last write and the newest one
+        return connectable.execute(sql.select(
+            [sql.func.max(self._writeMarks.c.written)])).scalar()
+
+    def mark_write(self, connection, writer):
+        # called in the transaction of every write, see
+        # get_replication_position
+        writer.upsert(connection, self._writeMarks,
+                      [{'name': u'write',
+                        'written': datetime.datetime.utcnow()}])
+
+    def open_connection(self):
+        """Open the connection the reads of this thread use until the
+        matching close_connection call, on a replica when replicas are
+        configured. Writes always go to the primary database.
+        """
+        if getattr(self._local, 'connection', None) is None:
+            if self._router is not None:
+                self._local.connection = self._router.connect()
+            else:
+                self._local.connection = self._db.bind.connect()
+            self._local.depth = 0
+        self._local.depth += 1
+        return self._local.connection
+
+    def close_connection(self):
+        self._local.depth -= 1
+        if self._local.depth == 0:
+            self._local.connection.close()
+            self._local.connection = None
+
+    def can_query_concurrently(self):
+        """Return whether queries can run side by side, which they can not
+        with one query thread or when every thread gets its own database
+        (in memory sqlite)."""
+        return not (self._queryThreads < 2 or
+                    isinstance(self._db.bind.pool,
+                               sql.pool.SingletonThreadPool))
+
+    def run_concurrently(self, calls):
+        """Call the functions in calls, query_threads of them at a time:
+        the first on the request thread and the others on helper threads
+        of the request, each with a connection of its own to the database
+        the request reads from. Return their results in the order of
+        calls."""
+        if not self.can_query_concurrently() or len(calls) < 2:
+            return [call() for call in calls]
+        connection = getattr(self._local, 'connection', None)
+        if connection is not None:
+            engine = connection.engine
+        elif self._router is not None:
+            engine = self._router.choose()
+        else:
+            engine = self._db.bind
+
+        def run(call, results, index):
+            try:
+                self._local.connection = engine.connect()
+                self._local.depth = 1
+                try:
+                    results[index] = (True, call())
+                finally:
+                    self.close_connection()
+            except Exception, err:
+                # raised again on the request thread
+                results[index] = (False, err)
+
+        results = []
+        for start in xrange(0, len(calls), self._queryThreads):
+            batch = calls[start:start + self._queryThreads]
+            helped = [None] * len(batch)
+            helpers = [threading.Thread(target=run,
+                                        args=(call, helped, index))
+                       for index, call in enumerate(batch) if index > 0]
+            for helper in helpers:
+                helper.start()
+            try:
+                helped[0] = (True, batch[0]())
+            finally:
+                for helper in helpers:
+                    helper.join()
+            for succeeded, result in helped:
+                if not succeeded:
+                    raise result
+                results.append(result)
+        return results
+
+    def execute(self, statement, *multiparams, **params):
+        # reads go through the open connection, if any
+        connection = getattr(self._local, 'connection', None) or self._db.bind
+        return connection.execute(statement, *multiparams, **params)
         
     def _connect(self):
         dburi = self._uri
@@ -59,72 +176,257 @@ class SQLDatabase(object):
                   sql.Column('set_id', sql.Integer,
                              sql.ForeignKey('sets.set_id'),
                              index=True, primary_key=True))
+
+        # number of records per set and datestamp day, the counts of
+        # all records are stored with an empty set_id
+        sql.Table('day_counts', db,
+                  sql.Column('set_id', sql.Unicode, primary_key=True),
+                  sql.Column('day', sql.Date, primary_key=True),
+                  sql.Column('records', sql.Integer, nullable=False))
+
+        # the partitions of a partitioned database, each is a table with
+        # the columns of records named records_<partition_key>
+        sql.Table('record_partitions', db,
+                  sql.Column('partition_key', sql.Unicode, primary_key=True))
+
+        # the time of the last write, datestamps come from the provider
+        # and do not tell how far behind a replica is
+        sql.Table('write_marks', db,
+                  sql.Column('name', sql.Unicode, primary_key=True),
+                  sql.Column('written', sql.DateTime, nullable=False))
         
         db.create_all()
         return db
 
     def flush(self):
-        oai_ids = set()
-        for row in sql.select([self._records.c.record_id]).execute():
-            oai_ids.add(row[0])
-        for row in sql.select([self._sets.c.set_id]).execute():
-            oai_ids.add(row[0])
-
-        deleted_records = []
-        deleted_sets = []
-        deleted_setrefs = []
-
-        inserted_records = []
-        inserted_sets = []
-        inserted_setrefs = []
-
-        
+        """Write the records and sets added since the last flush. The
+        cost only depends on the number of added items, the rows with
+        the same ids are replaced with a dialect specific bulk upsert.
+        """
+        records = []
         for oai_id, item in self._cache['records'].items():
-            if oai_id in oai_ids:
-                # record allready exists
-                deleted_records.append(oai_id)
             item['record_id'] = oai_id
-            inserted_records.append(item)
+            records.append(item)
 
+        sets = []
         for oai_id, item in self._cache['sets'].items():
-            if oai_id in oai_ids:
-                # set allready exists
-                deleted_sets.append(oai_id)
             item['set_id'] = oai_id
-            inserted_sets.append(item)
+            sets.append(item)
 
+        setrefs = []
         for record_id, set_ids in self._cache['setrefs'].items():
-            deleted_setrefs.append(record_id)
             for set_id in set_ids:
-                inserted_setrefs.append(
-                    {'record_id':record_id, 'set_id': set_id})
-
-        # delete all processed records before inserting
-        if deleted_records:
-            self._records.delete(
-                self._records.c.record_id == sql.bindparam('record_id')
-                ).execute(
-                [{'record_id': rid} for rid in deleted_records])
-        if deleted_sets:
-            self._sets.delete(
-                self._sets.c.set_id == sql.bindparam('set_id')
-                ).execute(
-                [{'set_id': sid} for sid in deleted_sets])
-        if deleted_setrefs:
-            self._setrefs.delete(
-                self._setrefs.c.record_id == sql.bindparam('record_id')
-                ).execute(
-                [{'record_id': rid} for rid in deleted_setrefs])
-
-        # batch inserts
-        if inserted_records:
-            self._records.insert().execute(inserted_records)
-        if inserted_sets:
-            self._sets.insert().execute(inserted_sets)
-        if inserted_setrefs:
-            self._setrefs.insert().execute(inserted_setrefs)
+                setrefs.append({'record_id': record_id, 'set_id': set_id})
+
+        connection = self._db.bind.connect()
+        transaction = connection.begin()
+        try:
+            writer = get_bulk_writer(connection)
+            old_counts = self.get_day_keys(connection,
+                                           self._cache['records'].keys())
+            if self._partitionBy is None:
+                writer.upsert(connection, self._records, records)
+            else:
+                self.write_partitions(connection, writer, records)
+            writer.upsert(connection, self._sets, sets)
+            writer.replace(connection, self._setrefs.c.record_id,
+                           self._cache['setrefs'].keys(), setrefs)
+            self.adjust_day_counts(connection, writer, old_counts, [
+                self.day_keys(item['modified'],
+                              self._cache['setrefs'].get(oai_id, []))
+                for oai_id, item in self._cache['records'].items()])
+            self.mark_write(connection, writer)
+            transaction.commit()
+        except:
+            transaction.rollback()
+            raise
+        finally:
+            connection.close()
 
         self._reset_cache()
+        self._identifiers = (None, None)
+
+    def partition_key(self, modified):
+        # the partition of a record with this datestamp
+        return u'%04d%02d' % (modified.year, modified.month)
+
+    def get_partition(self, key):
+        """Return the table of the partition with this key, it has the
+        columns of records. The table is not created here."""
+        name = 'records_%s' % key
+        self._partitionLock.acquire()
+        try:
+            table = self._db.tables.get(name)
+            if table is None:
+                table = sql.Table(name, self._db,
+                                  *[column.copy()
+                                    for column in self._records.columns])
+        finally:
+            self._partitionLock.release()
+        return table
+
+    def get_partitions(self, from_date=None, until_date=None):
+        """Return the tables of the partitions that can hold records
+        with datestamps between from_date and until_date, newest first."""
+        keys = self._partitions.c.partition_key
+        query = sql.select([keys], order_by=[sql.desc(keys)])
+        if from_date is not None:
+            query.append_whereclause(keys >= self.partition_key(from_date))
+        if until_date is not None:
+            query.append_whereclause(keys <= self.partition_key(until_date))
+        return [self.get_partition(row[0]) for row in self.execute(query)]
+
+    def remove_from_partitions(self, connection, writer, record_ids):
+        # delete the stored records with these ids from their partitions
+        record_ids = list(record_ids)
+        partitions = {}
+        for start in xrange(0, len(record_ids), 500):
+            for row in connection.execute(sql.select(
+                [self._records.c.record_id, self._records.c.modified],
+                self._records.c.record_id.in_(
+                    record_ids[start:start + 500]))):
+                partitions.setdefault(self.partition_key(row.modified),
+                                      []).append(row.record_id)
+        for key, ids in partitions.items():
+            writer.delete(connection, self.get_partition(key).c.record_id,
+                          ids)
+
+    def write_partitions(self, connection, writer, records):
+        """Store records in the partitions of their datestamps, creating
+        the partitions that do not exist yet. The records table keeps
+        the headers of all records, without metadata, so records can be
+        found without knowing their partition."""
+        self.remove_from_partitions(connection, writer,
+                                    [record['record_id']
+                                     for record in records])
+        partitions = {}
+        for record in records:
+            partitions.setdefault(self.partition_key(record['modified']),
+                                  []).append(record)
+        for key, rows in partitions.items():
+            table = self.get_partition(key)
+            table.create(connection, checkfirst=True)
+            writer.upsert(connection, table, rows)
+        writer.upsert(connection, self._partitions,
+                      [{'partition_key': key} for key in partitions])
+        writer.upsert(connection, self._records,
+                      [dict(record, metadata=None) for record in records])
+
+    def day_keys(self, modified, set_ids):
+        # the day_counts rows a record is counted in
+        day = modified.date()
+        return [(u'', day)] + [(set_id, day) for set_id in set_ids]
+
+    def get_day_keys(self, connection, record_ids):
+        """Return the day_counts keys of the stored records with these
+        ids."""
+        record_ids = list(record_ids)
+        days = {}
+        set_ids = {}
+        for start in xrange(0, len(record_ids), 500):
+            chunk = record_ids[start:start + 500]
+            for row in connection.execute(sql.select(
+                [self._records.c.record_id, self._records.c.modified],
+                self._records.c.record_id.in_(chunk))):
+                days[row.record_id] = row.modified
+            for row in connection.execute(sql.select(
+                [self._setrefs.c.record_id, self._setrefs.c.set_id],
+                self._setrefs.c.record_id.in_(chunk))):
+                set_ids.setdefault(row.record_id, []).append(row.set_id)
+        return [self.day_keys(modified, set_ids.get(record_id, []))
+                for record_id, modified in days.items()]
+
+    def adjust_day_counts(self, connection, writer, removed, added):
+        """Update the day_counts rows of the records that were removed
+        and added, both given as lists of day_keys results."""
+        changes = {}
+        for keys, change in [(removed, -1), (added, 1)]:
+            for record_keys in keys:
+                for key in record_keys:
+                    changes[key] = changes.get(key, 0) + change
+        changes = dict([(key, change) for key, change in changes.items()
+                        if change])
+        if not changes:
+            return
+        counts = self._dayCounts
+        days = sorted(set([day for set_id, day in changes]))
+        current = {}
+        for start in xrange(0, len(days), 500):
+            for row in connection.execute(sql.select(
+                [counts.c.set_id, counts.c.day, counts.c.records],
+                counts.c.day.in_(days[start:start + 500]))):
+                current[(row.set_id, row.day)] = row.records
+        rows = []
+        for (set_id, day), change in changes.items():
+            rows.append({'set_id': set_id, 'day': day,
+                         'records': current.get((set_id, day), 0) + change})
+        writer.upsert(connection, counts,
+                      [row for row in rows if row['records'] > 0])
+        empty = [row for row in rows if row['records'] <= 0]
+        if empty:
+            connection.execute(counts.delete(sql.and_(
+                counts.c.set_id == sql.bindparam('empty_set'),
+                counts.c.day == sql.bindparam('empty_day'))),
+                [{'empty_set': row['set_id'], 'empty_day': row['day']}
+                 for row in empty])
+
+    def update_day_counts(self):
+        # recount the records per set and day
+        day = day_of(self._db.bind, self._records.c.modified)
+        self._dayCounts.delete().execute()
+        self._dayCounts.insert().from_select(
+            ['set_id', 'day', 'records'],
+            sql.select([sql.literal(u'', sql.Unicode), day,
+                        sql.func.count()]).group_by(day)).execute()
+        self._dayCounts.insert().from_select(
+            ['set_id', 'day', 'records'],
+            sql.select([self._setrefs.c.set_id, day, sql.func.count()],
+                       self._setrefs.c.record_id == self._records.c.record_id
+                       ).group_by(self._setrefs.c.set_id, day)).execute()
+
+    def oai_count(self, needed_sets=None, disallowed_sets=None,
+                  allowed_sets=None, from_date=None, until_date=None):
+        """Return the number of records oai_query returns for these
+        arguments, or None when the day counts can not tell.
+        """
+        needed_sets = needed_sets or []
+        disallowed_sets = disallowed_sets or []
+        allowed_sets = allowed_sets or []
+        if until_date == None or until_date > datetime.datetime.utcnow():
+            until_date = datetime.datetime.utcnow()
+
+        def counter(set_ids):
+            set_ids = list(set_ids)
+            def count_days(first_day, last_day):
+                query = sql.select([sql.func.sum(self._dayCounts.c.records)],
+                                   self._dayCounts.c.day <= last_day)
+                if first_day is not None:
+                    query.append_whereclause(
+                        self._dayCounts.c.day >= first_day)
+                query.append_whereclause(
+                    self._dayCounts.c.set_id.in_(set_ids))
+                return self.execute(query).scalar() or 0
+
+            def count_range(start, end):
+                query = sql.select([sql.func.count()], sql.and_(
+                    self._records.c.modified >= start,
+                    self._records.c.modified < end))
+                if set_ids != [u'']:
+                    query.append_whereclause(sql.and_(
+                        self._setrefs.c.record_id == self._records.c.record_id,
+                        self._setrefs.c.set_id.in_(set_ids)))
+                return self.execute(query).scalar()
+            return lambda: count_window(from_date, until_date,
+                                        count_days, count_range)
+
+        if not (disallowed_sets or allowed_sets or len(needed_sets) > 1):
+            return counter(needed_sets or [u''])()
+        # a record has to be in all needed sets and in one of the
+        # allowed sets, so the window is empty when one of them is
+        for set_ids in [[set_id] for set_id in needed_sets] + [allowed_sets]:
+            if set_ids and counter(set_ids)() == 0:
+                return 0
+        return None
 
     def _reset_cache(self):
         self._cache = {'records': {}, 'sets': {}, 'setrefs': {}}
@@ -156,13 +458,7 @@ class SQLDatabase(object):
                    prefix="record %s" % oai_id,
                    suffix='for parameter "metadata"')
 
-        def date_handler(obj):
-            if hasattr(obj, 'isoformat'):
-                return obj.isoformat()
-            else:
-                raise TypeError, 'Object of type %s with value of %s is not JSON serializable' % (type(obj), repr(obj))
-
-        metadata = json.dumps(metadata, default=date_handler)
+        metadata = encode_metadata(metadata, self._codec)
         self._cache['records'][oai_id] = (dict(modified=modified,
                                                deleted=deleted,
                                                metadata=metadata))
@@ -175,20 +471,45 @@ class SQLDatabase(object):
             self._cache['setrefs'][oai_id].append(set_id)
             
     def get_record(self, oai_id):
-        row = self._records.select(
-            self._records.c.record_id == oai_id).execute().fetchone()
+        row = self.execute(self._records.select(
+            self._records.c.record_id == oai_id)).fetchone()
         if row is None:
             return
+        if self._partitionBy is None:
+            metadata = LazyMetadata(row.metadata)
+        else:
+            metadata = self.get_page_metadata([row]).get(row.record_id, {})
         record = {'id': row.record_id,
                   'deleted': row.deleted,
                   'modified': row.modified,
-                  'metadata': json.loads(row.metadata),
+                  'metadata': metadata,
                   'sets': self.get_setrefs(oai_id)}
         return record
 
+    def get_identifier_filter(self):
+        """Return an IdentifierFilter over all record ids. It is rebuilt
+        after a flush or removal, and when the time of the last write
+        changed, so a write by another process is noticed as well.
+        """
+        key = self.execute(sql.select(
+            [sql.func.max(self._writeMarks.c.written)])).scalar()
+        filter_key, identifiers = self._identifiers
+        if identifiers is None or filter_key != key:
+            identifiers = IdentifierFilter(
+                [row[0] for row in self.execute(
+                    sql.select([self._records.c.record_id]))])
+            self._identifiers = (key, identifiers)
+        return identifiers
+
+    def oai_may_exist(self, oai_id):
+        """Return False when there is no record with this id, True when
+        there probably is one.
+        """
+        return oai_id in self.get_identifier_filter()
+
     def get_set(self, oai_id):
-        row = self._sets.select(
-            self._sets.c.set_id == oai_id).execute().fetchone()
+        row = self.execute(self._sets.select(
+            self._sets.c.set_id == oai_id)).fetchone()
         if row is None:
             return
         return {'id': row.set_id,
@@ -205,121 +526,270 @@ class SQLDatabase(object):
                 sql.and_(self._sets.c.set_id == self._setrefs.c.set_id,
                          self._sets.c.hidden == include_hidden_sets))
         
-        for row in query.execute():
+        for row in self.execute(query):
             set_ids.append(row[0])
         set_ids.sort()
         return set_ids
 
+    def get_page_setrefs(self, record_ids):
+        """Return the sorted ids of the visible sets of every record id,
+        the sets get_setrefs returns, with one query for the setrefs of all
+        records and one for the visible set ids.
+        """
+        set_ids = dict([(record_id, []) for record_id in record_ids])
+        if not record_ids:
+            return set_ids
+        visible = set([row[0] for row in self.execute(sql.select(
+            [self._sets.c.set_id], self._sets.c.hidden == False))])
+        for row in self.execute(sql.select(
+            [self._setrefs.c.record_id, self._setrefs.c.set_id],
+            self._setrefs.c.record_id.in_(record_ids))):
+            if row.set_id in visible:
+                set_ids[row.record_id].append(row.set_id)
+        for ids in set_ids.values():
+            ids.sort()
+        return set_ids
+
     def record_count(self):
-        return sql.select([sql.func.count('*')],
-                          from_obj=[self._records]).execute().fetchone()[0]
+        return self.execute(sql.select([sql.func.count('*')],
+                          from_obj=[self._records])).fetchone()[0]
 
     def set_count(self):
-        return sql.select([sql.func.count('*')],
-                          from_obj=[self._sets]).execute().fetchone()[0]
+        return self.execute(sql.select([sql.func.count('*')],
+                          from_obj=[self._sets])).fetchone()[0]
         
     def remove_record(self, oai_id):
-        self._records.delete(
-            self._records.c.record_id == oai_id).execute()
-        self._setrefs.delete(
-            self._setrefs.c.record_id == oai_id).execute()
+        connection = self._db.bind.connect()
+        transaction = connection.begin()
+        try:
+            removed = self.get_day_keys(connection, [oai_id])
+            writer = get_bulk_writer(connection)
+            if self._partitionBy is not None:
+                self.remove_from_partitions(connection, writer, [oai_id])
+            connection.execute(self._records.delete(
+                self._records.c.record_id == oai_id))
+            connection.execute(self._setrefs.delete(
+                self._setrefs.c.record_id == oai_id))
+            self.adjust_day_counts(connection, writer, removed, [])
+            self.mark_write(connection, writer)
+            transaction.commit()
+        except:
+            transaction.rollback()
+            raise
+        finally:
+            connection.close()
+        self._identifiers = (None, None)
 
     def remove_set(self, oai_id):
         self._sets.delete(
             self._sets.c.set_id == oai_id).execute()
         self._setrefs.delete(
             self._setrefs.c.set_id == oai_id).execute()
+        self.update_day_counts()
+        connection = self._db.bind.connect()
+        try:
+            self.mark_write(connection, get_bulk_writer(connection))
+        finally:
+            connection.close()
 
     def oai_sets(self, offset=0, batch_size=20):
-        for row in self._sets.select(
+        for row in self.execute(self._sets.select(
               self._sets.c.hidden == False
-            ).offset(offset).limit(batch_size).execute():
+            ).offset(offset).limit(batch_size)):
             yield {'id': row.set_id,
                    'name': row.name,
                    'description': row.description}
 
     def oai_earliest_datestamp(self):
-        row = sql.select([self._records.c.modified],
+        row = self.execute(sql.select([self._records.c.modified],
                          order_by=[sql.asc(self._records.c.modified)]
-                         ).limit(1).execute().fetchone()
+                         ).limit(1)).fetchone()
         if row:
             return row[0]
         return datetime.datetime(1970, 1, 1)
     
-    def oai_query(self,
-                  offset=0,
-                  batch_size=20,
-                  needed_sets=None,
-                  disallowed_sets=None,
-                  allowed_sets=None,
-                  from_date=None,
-                  until_date=None,
-                  identifier=None):
-
-        needed_sets = needed_sets or []
-        disallowed_sets = disallowed_sets or []
-        allowed_sets = allowed_sets or []
-        if batch_size < 0:
-            batch_size = 0
-
+    def get_set_clause(self, needed_sets, disallowed_sets, allowed_sets,
+                       records=None):
+        """Return the where clause that filters records on their sets, or
+        None when there are no sets to filter on.
+
+        The sets are checked with one semi-join over setrefs, whatever
+        the number of sets: the refs of a record to the sets that matter
+        are grouped, and the number of needed, allowed and disallowed
+        sets among them decides if the record is listed. Records without
+        sets have no refs, so when only disallowed sets are given they
+        are filtered with an anti-join instead. records is the table the
+        records are selected from, the records table by default.
+        """
+        if records is None:
+            records = self._records
+        needed_sets = sorted(set(needed_sets or []))
+        disallowed_sets = sorted(set(disallowed_sets or []))
+        allowed_sets = sorted(set(allowed_sets or []))
+        record_id = self._setrefs.c.record_id
+        set_id = self._setrefs.c.set_id
+
+        if not (needed_sets or allowed_sets):
+            if not disallowed_sets:
+                return None
+            return sql.not_(records.c.record_id.in_(
+                sql.select([record_id], set_id.in_(disallowed_sets))))
+
+        def refs(sets):
+            return sql.func.sum(sql.case([(set_id.in_(sets), 1)], else_=0))
+
+        having = []
+        if needed_sets:
+            having.append(refs(needed_sets) == len(needed_sets))
+        if disallowed_sets:
+            having.append(refs(disallowed_sets) == 0)
+        if allowed_sets and having:
+            having.append(refs(allowed_sets) > 0)
+        # with only allowed sets every ref selected by the where clause
+        # lists the record, no grouping is needed
+        refs_query = sql.select(
+            [record_id],
+            set_id.in_(sorted(set(needed_sets + disallowed_sets +
+                                  allowed_sets))))
+        if having:
+            refs_query = refs_query.group_by(record_id).having(
+                sql.and_(*having))
+        return records.c.record_id.in_(refs_query)
+
+    def get_records_query(self,
+                          needed_sets=None,
+                          disallowed_sets=None,
+                          allowed_sets=None,
+                          from_date=None,
+                          until_date=None,
+                          identifier=None,
+                          records=None):
+        """Return the query that selects the header columns of the
+        records listed by oai_query, newest first, from records (the
+        records table by default, or a partition)."""
+        if records is None:
+            records = self._records
         # make sure until date is set, and not in future
         if until_date == None or until_date > datetime.datetime.utcnow():
             until_date = datetime.datetime.utcnow()
 
-
-        query = self._records.select(
-            order_by=[sql.desc(self._records.c.modified)])
+        # only the header columns are selected while filtering, the
+        # metadata is loaded for the records of the batch
+        query = sql.select([records.c.record_id,
+                            records.c.modified,
+                            records.c.deleted],
+                           order_by=[sql.desc(records.c.modified)])
 
         # filter dates
-        query.append_whereclause(self._records.c.modified <= until_date)
+        query.append_whereclause(records.c.modified <= until_date)
 
         if not identifier is None:
-            query.append_whereclause(self._records.c.record_id == identifier)
+            query.append_whereclause(records.c.record_id == identifier)
 
         if not from_date is None:
-            query.append_whereclause(self._records.c.modified >= from_date)
+            query.append_whereclause(records.c.modified >= from_date)
+
+        set_clause = self.get_set_clause(needed_sets, disallowed_sets,
+                                         allowed_sets, records)
+        if set_clause is not None:
+            query.append_whereclause(set_clause)
+        return query
+
+    def explain(self, statement):
+        """Return the query plan of statement as lines of text, or None
+        when the dialect is not sqlite or postgresql."""
+        dialect = self._db.bind.dialect
+        prefix = {'sqlite': 'EXPLAIN QUERY PLAN ',
+                  'postgresql': 'EXPLAIN '}.get(dialect.name)
+        if prefix is None:
+            return None
+        query = unicode(statement.compile(
+            dialect=dialect, compile_kwargs={'literal_binds': True}))
+        rows = self.execute(sql.text(prefix + query)).fetchall()
+        if dialect.name == 'sqlite':
+            # id, parent, notused, detail
+            return [row[-1] for row in rows]
+        return [row[0] for row in rows]
+
+    def query_partitions(self, offset, batch_size, needed_sets,
+                         disallowed_sets, allowed_sets, from_date,
+                         until_date, identifier):
+        """Return the header rows of a page of oai_query from the
+        partitions. Only the partitions of the months between from_date
+        and until_date are queried, query_threads of them side by side,
+        newest first, until the page is filled. The partitions hold
+        disjoint months, so their rows are in datestamp order when the
+        partitions are.
+        """
+        partitions = self.get_partitions(from_date, until_date)
+        wanted = offset + batch_size
+        step = max(self._queryThreads, 1)
+        rows = []
+        for start in xrange(0, len(partitions), step):
+            if len(rows) >= wanted:
+                break
+            limit = wanted - len(rows)
+            calls = [lambda table=table: self.execute(self.get_records_query(
+                         needed_sets, disallowed_sets, allowed_sets,
+                         from_date, until_date, identifier,
+                         table).limit(limit)).fetchall()
+                     for table in partitions[start:start + step]]
+            for partition_rows in self.run_concurrently(calls):
+                rows.extend(partition_rows)
+        return rows[offset:wanted]
+
+    def get_page_metadata(self, rows):
+        """Return the metadata of the records of these header rows by
+        record id, with one query per table the records are stored in.
+        It is decoded when it is first used."""
+        record_ids = {}
+        for row in rows:
+            if self._partitionBy is None:
+                table = self._records
+            else:
+                table = self.get_partition(self.partition_key(row.modified))
+            record_ids.setdefault(table, []).append(row.record_id)
+        metadata = {}
+        for table, ids in record_ids.items():
+            for row in self.execute(sql.select(
+                [table.c.record_id, table.c.metadata],
+                table.c.record_id.in_(ids))):
+                metadata[row.record_id] = LazyMetadata(row.metadata)
+        return metadata
 
-        # filter sets
+    def oai_query(self,
+                  offset=0,
+                  batch_size=20,
+                  needed_sets=None,
+                  disallowed_sets=None,
+                  allowed_sets=None,
+                  from_date=None,
+                  until_date=None,
+                  identifier=None,
+                  with_metadata=True):
 
-        setclauses = []
-        for set_id in needed_sets:
-            alias = self._setrefs.alias()
-            setclauses.append(
-                sql.and_(
-                alias.c.set_id == set_id,
-                alias.c.record_id == self._records.c.record_id))
-            
-        if setclauses:
-            query.append_whereclause((sql.and_(*setclauses)))
-            
-        allowed_setclauses = []
-        for set_id in allowed_sets:
-            alias = self._setrefs.alias()
-            allowed_setclauses.append(
-                sql.and_(
-                alias.c.set_id == set_id,
-                alias.c.record_id == self._records.c.record_id))
-            
-        if allowed_setclauses:
-            query.append_whereclause(sql.or_(*allowed_setclauses))
-
-        disallowed_setclauses = []
-        for set_id in disallowed_sets:
-            alias = self._setrefs.alias()
-            disallowed_setclauses.append(
-                sql.exists([self._records.c.record_id],
-                           sql.and_(
-                alias.c.set_id == set_id,
-                alias.c.record_id == self._records.c.record_id)))
-            
-        if disallowed_setclauses:
-            query.append_whereclause(sql.not_(sql.or_(*disallowed_setclauses)))
-            
-        for row in query.distinct().offset(offset).limit(batch_size).execute():
+        if batch_size < 0:
+            batch_size = 0
+        if self._partitionBy is None:
+            query = self.get_records_query(needed_sets, disallowed_sets,
+                                           allowed_sets, from_date,
+                                           until_date, identifier)
+            rows = self.execute(
+                query.offset(offset).limit(batch_size)).fetchall()
+        else:
+            rows = self.query_partitions(offset, batch_size, needed_sets,
+                                         disallowed_sets, allowed_sets,
+                                         from_date, until_date, identifier)
+        setrefs = self.get_page_setrefs([row.record_id for row in rows])
+        metadata = {}
+        if with_metadata:
+            metadata = self.get_page_metadata(rows)
+
+        for row in rows:
             yield {'id': row.record_id,
                    'deleted': row.deleted,
                    'modified': row.modified,
-                   'metadata': json.loads(row.metadata),
-                   'sets': self.get_setrefs(row.record_id)
+                   'metadata': metadata.get(row.record_id, {}),
+                   'sets': setrefs[row.record_id]
                    }
 
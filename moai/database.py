@@ -1,11 +1,20 @@
 import datetime
 import json
 import re
+import heapq
+import threading
 from pkg_resources import iter_entry_points
 
 import sqlalchemy as sql
 
-from moai.utils import check_type
+from moai.utils import check_type, LRUCache, IdentifierFilter
+from moai.replication import get_replica_router
+from moai.histogram import day_of, count_window
+
+# word breaks and control characters in labman texts, see normalize_text
+text_breaks = re.compile(u'-\n|[\n\r\t\b\f]', re.UNICODE)
+text_replacements = {u'\n': u' '}
+
 
 def get_database(uri, config=None):
     prefix = uri.split(':')[0]
@@ -40,9 +49,74 @@ class SQLDatabase(object):
                     'book': 'publications_book',
                     'section': 'publications_booksection',
                     'thesis': 'publications_thesis',
-                    'abstract': 'publications_thesisabstract'
+                    'abstract': 'publications_thesisabstract',
+                    'record_index': 'moai_records',
+                    'latest_action': 'moai_latest_actions',
+                    'state': 'moai_state',
+                    'day_count': 'moai_day_counts'
                   }
 
+    # child types whose datestamp depends on a parent row, mapped to the
+    # child table key and the column that references the parent.
+    parent_refs = {'ConferencePaper': ('paper', 'parent_proceedings_id'),
+                   'MagazineArticle': ('mag_article', 'parent_magazine_id'),
+                   'JournalArticle': ('jour_article', 'parent_journal_id'),
+                   'BookSection': ('section', 'parent_book_id')}
+
+    # the table holding the parent row (with the publisher) of each child
+    # type, for the types without a parent this is the child table itself.
+    parent_tables = {'Proceedings': 'proceeding',
+                     'ConferencePaper': 'proceeding',
+                     'Magazine': 'magazine',
+                     'MagazineArticle': 'magazine',
+                     'Journal': 'journal',
+                     'JournalArticle': 'journal',
+                     'Book': 'book',
+                     'BookSection': 'book'}
+
+    # the method that maps the labman row of a set to metadata, the
+    # publication sets without an entry use map_publication.
+    record_mappers = {'Thesis': 'map_thesis'}
+
+    # the columns index entries and datestamps are computed from, the
+    # large text columns are only loaded for the records that are rendered.
+    header_columns = {u'publication': ('id', 'slug', 'child_type',
+                                       'language_id', 'year'),
+                      u'thesis': ('id', 'slug', 'main_language_id',
+                                  'author_id', 'year')}
+
+    # reference tables that are cached in memory, mapped to the column
+    # that is looked up by id.
+    reference_columns = {'language': 'language_tag',
+                         'tag': 'name',
+                         'author': 'full_name'}
+
+    reference_cache_size = 10000
+
+    # indexes on the labman tables the queries of moai depend on, as
+    # (index name, table, columns). Django does not create them, the
+    # indexes_moai script does.
+    required_indexes = [
+      ('moai_admin_log_object', 'django_admin_log',
+       ('content_type_id', 'object_id')),
+      ('moai_publicationauthor_publication', 'pub_author',
+       ('publication_id',)),
+      ('moai_publicationtag_publication', 'pub_tag', ('publication_id',)),
+      ('moai_thesisabstract_thesis', 'abstract', ('thesis_id',))]
+
+    # threads that run the queries of the publications and the theses
+    # side by side, 1 runs them one after the other.
+    query_threads = 2
+
+    # settings of the app section that are passed on to create_engine,
+    # mapped to the function that converts the value
+    pool_options = {'pool_size': int,
+                    'max_overflow': int,
+                    'pool_timeout': int,
+                    'pool_recycle': int,
+                    'pool_pre_ping': lambda value: value.lower() in (
+                      'true', 'yes', 'on', '1')}
+
     #TODO add some real info here.
     sets = json.loads(
       """[
@@ -65,8 +139,11 @@ class SQLDatabase(object):
           "description": "A set related to Thesis", "hidden": 0}
       ]""")
 
-    def __init__(self, dburi=None):
+    def __init__(self, dburi=None, config=None):
         self._uri = dburi
+        config = config or {}
+        self._config = config
+        self._local = threading.local()
         self._db = self._connect()
         self._languages = self._db.tables[self.table_names.get('language')]
         self._tags = self._db.tables[self.table_names.get('tag')]
@@ -86,13 +163,30 @@ class SQLDatabase(object):
         self._thesisabstract = self._db.tables[self.table_names.get('abstract')]
         self._djangoLog = self._db.tables['django_admin_log']
         self._djangoContentType = self._db.tables['django_content_type']
+        self._recordIndex = self._db.tables[self.table_names.get('record_index')]
+        self._latestAction = self._db.tables[self.table_names.get('latest_action')]
+        self._state = self._db.tables[self.table_names.get('state')]
+        self._dayCount = self._db.tables[self.table_names.get('day_count')]
+        self._reference = LRUCache(int(config.get('reference_cache_size',
+          self.reference_cache_size)))
+        self._referenceLogId = None
+        self._identifiers = (None, None)
+        self._statements = {}
+        self._compiledCache = {}
+        self._statementHits = 0
+        self._compiled = self._db.bind.execution_options(
+          compiled_cache=self._compiledCache)
+        self._router = get_replica_router(self._db.bind, config,
+          self.get_replication_position, self.get_engine_options())
+        self._queryThreads = int(config.get('query_threads',
+          self.query_threads))
         
     def _connect(self):
         dburi = self._uri
         if dburi is None:
             dburi = 'sqlite:///:memory:'
             
-        engine = sql.create_engine(dburi)
+        engine = sql.create_engine(dburi, **self.get_engine_options())
         db = sql.MetaData(engine)
          
         sql.Table('utils_language', db,
@@ -257,6 +351,36 @@ class SQLDatabase(object):
           sql.Column('action_flag', sql.Unicode, nullable=False),
           sql.Column('change_message', sql.Unicode, nullable=False))
 
+        # tables below are owned by MOAI, not by labman
+        sql.Table('moai_records', db,
+          sql.Column('record_type', sql.Unicode(16), primary_key=True),
+          sql.Column('record_id', sql.Integer, primary_key=True,
+                     autoincrement=False),
+          sql.Column('oai_id', sql.Unicode(255), nullable=False, index=True),
+          sql.Column('set_spec', sql.Unicode(64), nullable=False, index=True),
+          sql.Column('modified', sql.DateTime, nullable=False),
+          sql.Column('deleted', sql.Boolean, nullable=False),
+          # the order oai_query pages in, see oai_seek_key
+          sql.Index('moai_records_order', 'modified', 'record_type',
+                    'record_id'))
+
+        sql.Table('moai_latest_actions', db,
+          sql.Column('content_type_id', sql.Integer, primary_key=True,
+                     autoincrement=False),
+          sql.Column('object_id', sql.Unicode(255), primary_key=True),
+          sql.Column('action_time', sql.DateTime(timezone=True),
+                     nullable=False))
+
+        sql.Table('moai_state', db,
+          sql.Column('name', sql.Unicode(64), primary_key=True),
+          sql.Column('value', sql.Unicode))
+
+        # number of indexed records per set and datestamp day
+        sql.Table('moai_day_counts', db,
+          sql.Column('set_spec', sql.Unicode(64), primary_key=True),
+          sql.Column('day', sql.Date, primary_key=True),
+          sql.Column('records', sql.Integer, nullable=False))
+
         db.create_all()
         return db
 
@@ -286,12 +410,12 @@ class SQLDatabase(object):
         return set_ids"""
 
     def record_count(self):
-        return sql.select([sql.func.count('*')],
-                          from_obj=[self._records]).execute().fetchone()[0]
+        return self.execute(sql.select([sql.func.count('*')],
+                          from_obj=[self._records])).fetchone()[0]
 
     def set_count(self):
-        return sql.select([sql.func.count('*')],
-                          from_obj=[self._sets]).execute().fetchone()[0]
+        return self.execute(sql.select([sql.func.count('*')],
+                          from_obj=[self._sets])).fetchone()[0]
 
     def oai_sets(self, offset=0, batch_size=20):
         index = offset
@@ -306,10 +430,10 @@ class SQLDatabase(object):
 
     def oai_earliest_datestamp(self):
         earliest_datestamp = datetime.datetime(1970, 1, 1)
-        publication_earliest_datestamp = sql.select([self._publication.c.year],
-          order_by=[sql.asc(self._publication.c.year)]).limit(1).execute().fetchone()
-        thesis_earliest_datestamp = sql.select([self._thesis.c.year],
-          order_by=[sql.asc(self._thesis.c.year)]).limit(1).execute().fetchone()
+        publication_earliest_datestamp = self.execute(sql.select([self._publication.c.year],
+          order_by=[sql.asc(self._publication.c.year)]).limit(1)).fetchone()
+        thesis_earliest_datestamp = self.execute(sql.select([self._thesis.c.year],
+          order_by=[sql.asc(self._thesis.c.year)]).limit(1)).fetchone()
         if publication_earliest_datestamp:
           earliest_datestamp = publication_earliest_datestamp[0]
         if thesis_earliest_datestamp:
@@ -317,68 +441,274 @@ class SQLDatabase(object):
             return datetime.datetime(thesis_earliest_datestamp[0], 1, 1)
         return datetime.datetime(earliest_datestamp, 1, 1)
     
-    def process_control_char_word_break(self, text):
-      p = re.compile(ur'-\n', re.UNICODE)
-      processed_text = re.sub(p, u'', text)
-      processed_text = processed_text.replace('\\', '\\\\')
-      processed_text = processed_text.replace('\n', ' ')
-      processed_text = processed_text.replace('\"', '\\"')
-      processed_text = processed_text.replace('\r', '')
-      processed_text = processed_text.replace('\t', '')
-      processed_text = processed_text.replace('\b', '')
-      processed_text = processed_text.replace('\f', '')
-
-      return processed_text
+    def normalize_text(self, text):
+      """Join words broken over two lines, turn the other newlines into
+      spaces and drop control characters, in one pass over the text."""
+      return text_breaks.sub(
+        lambda match: text_replacements.get(match.group(), u''), text)
+
+    def get_statement(self, key, build):
+      """Return the statement stored under key, calling build to create
+      it with bind parameters the first time. Statements run through
+      execute_statement are compiled once and reused after that."""
+      statement = self._statements.get(key)
+      if statement is None:
+        statement = build()
+        self._statements[key] = statement
+      else:
+        self._statementHits += 1
+      return statement
+
+    def get_engine_options(self):
+      options = {}
+      for name, convert in self.pool_options.items():
+        value = self._config.get(name)
+        if value is not None:
+          options[name] = convert(value)
+      return options
+
+    def get_replication_position(self, connectable):
+      """Return the time of the newest admin log entry, replicas that are
+      behind the primary by more than replica_max_lag are not read."""
+      position = connectable.execute(sql.select(
+        [sql.func.max(self._djangoLog.c.action_time)])).scalar()
+      if position is not None:
+        position = position.replace(tzinfo=None)
+      return position
+
+    def open_connection(self):
+      """Check out a connection from the pool that all queries of this
+      thread use until the matching close_connection call. Calls can be
+      nested, the server opens one connection for every request. When
+      replicas are configured the connection is made to one of them, so
+      it must only be used for reading."""
+      if getattr(self._local, 'connection', None) is None:
+        if self._router is not None:
+          self._local.connection = self._router.connect()
+        else:
+          self._local.connection = self._db.bind.connect()
+        self._local.compiled = self._local.connection.execution_options(
+          compiled_cache=self._compiledCache)
+        self._local.depth = 0
+        self._local.actions_refreshed = False
+      self._local.depth += 1
+      return self._local.connection
+
+    def close_connection(self):
+      self._local.depth -= 1
+      if self._local.depth == 0:
+        self._local.connection.close()
+        self._local.connection = None
+        self._local.compiled = None
+
+    def get_primary(self):
+      """Return the open connection when it is made to the primary, or
+      else the primary engine."""
+      connection = getattr(self._local, 'connection', None)
+      if connection is not None and self._router is None:
+        return connection
+      return self._db.bind
+
+    def execute(self, statement, *multiparams, **params):
+      """Execute statement on the connection of the current request, or
+      on a connection of its own when no connection is open."""
+      connection = getattr(self._local, 'connection', None) or self._db.bind
+      return connection.execute(statement, *multiparams, **params)
+
+    def execute_statement(self, statement, params=None):
+      connection = getattr(self._local, 'compiled', None) or self._compiled
+      return connection.execute(statement, params or {})
+
+    def can_query_concurrently(self):
+      """Return whether queries can run side by side, which they can not
+      with one query thread or when every thread gets its own database
+      (in memory sqlite)."""
+      return not (self._queryThreads < 2 or
+        isinstance(self._db.bind.pool, sql.pool.SingletonThreadPool))
+
+    def run_concurrently(self, calls):
+      """Call the functions in calls, query_threads of them at a time: the
+      first on the request thread and the others on helper threads of the
+      request, each with a connection of its own to the database the
+      request reads from. Return their results in the order of calls."""
+      if not self.can_query_concurrently() or len(calls) < 2:
+        return [call() for call in calls]
+      # the calls read the rollup as this request refreshed it
+      self.ensure_latest_actions()
+      connection = getattr(self._local, 'connection', None)
+      if connection is not None:
+        engine = connection.engine
+      elif self._router is not None:
+        engine = self._router.choose()
+      else:
+        engine = self._db.bind
+
+      def run(call, results, index):
+        try:
+          self._local.connection = engine.connect()
+          self._local.compiled = self._local.connection.execution_options(
+            compiled_cache=self._compiledCache)
+          self._local.depth = 1
+          self._local.actions_refreshed = True
+          try:
+            results[index] = (True, call())
+          finally:
+            self.close_connection()
+        except Exception, err:
+          # raised again on the request thread
+          results[index] = (False, err)
+
+      results = []
+      for start in xrange(0, len(calls), self._queryThreads):
+        batch = calls[start:start + self._queryThreads]
+        helped = [None] * len(batch)
+        helpers = [threading.Thread(target=run, args=(call, helped, index))
+                   for index, call in enumerate(batch) if index > 0]
+        for helper in helpers:
+          helper.start()
+        try:
+          helped[0] = (True, batch[0]())
+        finally:
+          for helper in helpers:
+            helper.join()
+        for succeeded, result in helped:
+          if not succeeded:
+            raise result
+          results.append(result)
+      return results
+
+    def pool_stats(self):
+      """Report the state of the connection pool, as far as the pool
+      class used for the database keeps track of it."""
+      pool = self._db.bind.pool
+      stats = {'pool': pool.__class__.__name__}
+      for name in ('size', 'checkedin', 'checkedout', 'overflow'):
+        if callable(getattr(pool, name, None)):
+          stats[name] = getattr(pool, name)()
+      if self._router is not None:
+        stats['replication'] = self._router.stats()
+      return stats
+
+    def statement_cache_stats(self):
+      return {'statements': len(self._statements),
+              'compiles': len(self._compiledCache),
+              'hits': self._statementHits}
+
+    def get_missing_indexes(self):
+      """Return the required_indexes, with the table name, for which the
+      database has no index or primary key starting with their
+      columns."""
+      inspector = sql.inspect(self._db.bind)
+      missing = []
+      for name, table, columns in self.required_indexes:
+        table = self.table_names.get(table, table)
+        existing = [tuple(index['column_names'])
+          for index in inspector.get_indexes(table)]
+        existing.append(tuple(
+          inspector.get_pk_constraint(table)['constrained_columns']))
+        if tuple(columns) not in [index[:len(columns)] for index in existing]:
+          missing.append((name, table, columns))
+      return missing
+
+    def create_indexes(self):
+      """Create the missing required_indexes and return them. Indexes
+      that exist are left alone, so this can be run again."""
+      missing = self.get_missing_indexes()
+      for name, table, columns in missing:
+        table = self._db.tables[table]
+        sql.Index(name, *[table.c[column] for column in columns]).create(
+          self._db.bind)
+      return missing
+
+    def get_hot_queries(self):
+      """Return the queries the required_indexes are for, with example
+      values, as (description, statement) pairs."""
+      log = self._djangoLog
+      authors = self._publicationauthor
+      tags = self._publicationtag
+      abstracts = self._thesisabstract
+      return [('admin log entries of an object',
+               sql.select([log.c.action_time], sql.and_(
+                 log.c.content_type_id == 1, log.c.object_id == u'1'))),
+              ('authors of publications',
+               sql.select([authors.c.publication_id, authors.c.author_id],
+                 authors.c.publication_id.in_([1, 2]))),
+              ('tags of publications',
+               sql.select([tags.c.publication_id, tags.c.tag_id],
+                 tags.c.publication_id.in_([1, 2]))),
+              ('abstracts of theses',
+               sql.select([abstracts.c.thesis_id, abstracts.c.abstract],
+                 abstracts.c.thesis_id.in_([1, 2])))]
+
+    def explain(self, statement):
+      """Return the query plan of statement as lines of text, or None
+      when the dialect is not sqlite or postgresql."""
+      dialect = self._db.bind.dialect
+      prefix = {'sqlite': 'EXPLAIN QUERY PLAN ',
+                'postgresql': 'EXPLAIN '}.get(dialect.name)
+      if prefix is None:
+        return None
+      query = unicode(statement.compile(dialect=dialect,
+        compile_kwargs={'literal_binds': True}))
+      rows = self._db.bind.execute(sql.text(prefix + query)).fetchall()
+      if dialect.name == 'sqlite':
+        # id, parent, notused, detail
+        return [row[-1] for row in rows]
+      return [row[0] for row in rows]
+
+    def _search(self, name, table, **columns):
+      # select the rows of table where the columns equal the given values
+      statement = self.get_statement(name, lambda: table.select(sql.and_(
+        *[table.c[column] == sql.bindparam(column) for column in columns])))
+      return self.execute_statement(statement, columns)
 
     def search_language(self, lg_id):
-      return self._languages.select(
-        self._languages.c.id == lg_id).execute().fetchone()
+      return self._search('search_language', self._languages,
+        id=lg_id).fetchone()
 
     def search_proceeding(self, pr_id):
-      return self._proceedings.select(
-        self._proceedings.c.publication_ptr_id == pr_id).execute().fetchone()
+      return self._search('search_proceeding', self._proceedings,
+        publication_ptr_id=pr_id).fetchone()
 
     def search_magazine(self, mg_id):
-      return self._magazine.select(
-        self._magazine.c.publication_ptr_id == mg_id).execute().fetchone()
+      return self._search('search_magazine', self._magazine,
+        publication_ptr_id=mg_id).fetchone()
 
     def search_journal(self, jr_id):
-      return self._journal.select(
-        self._journal.c.publication_ptr_id == jr_id).execute().fetchone()
+      return self._search('search_journal', self._journal,
+        publication_ptr_id=jr_id).fetchone()
 
     def search_book(self, bk_id):
-      return self._book.select(
-        self._book.c.publication_ptr_id == bk_id).execute().fetchone()
+      return self._search('search_book', self._book,
+        publication_ptr_id=bk_id).fetchone()
 
     def search_all_records_author(self, record_id):
-      return self._publicationauthor.select(
-        self._publicationauthor.c.publication_id == record_id).execute().fetchall()
+      return self._search('search_all_records_author',
+        self._publicationauthor, publication_id=record_id).fetchall()
 
     def search_author(self, author_id):
-      return self._authors.select(
-        self._authors.c.id == author_id).execute().fetchone()
+      return self._search('search_author', self._authors,
+        id=author_id).fetchone()
 
     def search_all_tags(self, record_id):
-      return self._publicationtag.select(
-        self._publicationtag.c.publication_id == record_id).execute().fetchall()
+      return self._search('search_all_tags', self._publicationtag,
+        publication_id=record_id).fetchall()
 
     def seach_tag(self, tg_id):
-      return self._tags.select(
-          self._tags.c.id == tg_id).execute().fetchone()
+      return self._search('search_tag', self._tags, id=tg_id).fetchone()
 
     def search_all_thesis_abstract(self, thesis_id):
-      return self._thesisabstract.select(
-        self._thesisabstract.c.thesis_id == thesis_id).execute().fetchall()
+      return self._search('search_all_thesis_abstract',
+        self._thesisabstract, thesis_id=thesis_id).fetchall()
 
     def search_content_type(self, app_label, model):
-      return self._djangoContentType.select(
-        self._djangoContentType.c.model == model).where(
-        self._djangoContentType.c.app_label == app_label).execute().fetchone()
+      return self._search('search_content_type', self._djangoContentType,
+        model=model, app_label=app_label).fetchone()
 
     def search_logs(self, content_type, object_id):
-      return self._djangoLog.select().where(
-        self._djangoLog.c.object_id == unicode(object_id)).where(
-        self._djangoLog.c.content_type_id == content_type).execute().fetchall()
+      return self._search('search_logs', self._djangoLog,
+        object_id=unicode(object_id),
+        content_type_id=content_type).fetchall()
 
     def get_publication_setspec(self, dc_type):
       setspec = None
@@ -410,8 +740,8 @@ class SQLDatabase(object):
         if proceeding is not None:
           child = proceeding
       elif dc_type == 'ConferencePaper':
-        conferencePaper = self._conferencePaper.select(
-          self._conferencePaper.c.publication_ptr_id == record_id).execute().fetchone()
+        conferencePaper = self.execute(self._conferencePaper.select(
+          self._conferencePaper.c.publication_ptr_id == record_id)).fetchone()
         if conferencePaper is not None:
           proceeding = self.search_proceeding(conferencePaper.parent_proceedings_id)
           if proceeding is not None:
@@ -421,8 +751,8 @@ class SQLDatabase(object):
         if magazine is not None:
           child = magazine
       elif dc_type == 'MagazineArticle':
-        magazineArticle = self._magazineArticle.select(
-          self._magazineArticle.c.publication_ptr_id == record_id).execute().fetchone()
+        magazineArticle = self.execute(self._magazineArticle.select(
+          self._magazineArticle.c.publication_ptr_id == record_id)).fetchone()
         if magazineArticle is not None:
           magazine = self.search_magazine(magazineArticle.parent_magazine_id)
           if magazine is not None:
@@ -432,8 +762,8 @@ class SQLDatabase(object):
         if journal is not None:
           child = journal
       elif dc_type == 'JournalArticle':
-        journalArticle = self._journalArticle.select(
-          self._journalArticle.c.publication_ptr_id == record_id).execute().fetchone()
+        journalArticle = self.execute(self._journalArticle.select(
+          self._journalArticle.c.publication_ptr_id == record_id)).fetchone()
         if journalArticle is not None:
           journal = self.search_journal(journalArticle.parent_journal_id)
           if journal is not None:
@@ -443,8 +773,8 @@ class SQLDatabase(object):
         if book is not None:
           child = book
       elif dc_type == 'BookSection':
-        bookSection = self._bookSection.select(
-          self._bookSection.c.publication_ptr_id == record_id).execute().fetchone()
+        bookSection = self.execute(self._bookSection.select(
+          self._bookSection.c.publication_ptr_id == record_id)).fetchone()
         if bookSection is not None:
           book = self.search_book(bookSection.parent_book_id)
           if book is not None:
@@ -454,69 +784,105 @@ class SQLDatabase(object):
     def get_publisher(self, dc_type, record_id):
       return self.get_parent_type(dc_type, record_id).publisher
 
-    def get_pubmetadata(self, record):
-      metadata = '{"title":["' + self.process_control_char_word_break(record.title) + '"], ' \
-        '"date":["' + record.published.strftime('%Y-%m-%dT%H:%M:%SZ') + '"]' \
-        ', "format":["digital"], "type":["' + record.child_type + '"]'
-      publisher = self.get_publisher(record.child_type, record.id)
-      if publisher is not None:
-        metadata += ', "publisher":["' + publisher + '"]'
+    def get_publications_related(self, records):
+      """Fetch the authors, tags, languages and parents of a page of
+      publications with one query each (one per child type for parents).
+      Returns dicts keyed by publication id (author names ordered by
+      position, tag names, parent rows) and language id (tags)."""
+      record_ids = [record.id for record in records]
+      language_ids = set([record.language_id for record in records
+        if record.language_id is not None])
+      authors = {}
+      tags = {}
+      languages = {}
+      if record_ids:
+        author_ids = {}
+        for row in self.execute(sql.select([self._publicationauthor.c.publication_id,
+            self._publicationauthor.c.author_id],
+            self._publicationauthor.c.publication_id.in_(record_ids),
+            order_by=[self._publicationauthor.c.publication_id,
+                      self._publicationauthor.c.position])):
+          author_ids.setdefault(row.publication_id, []).append(row.author_id)
+        names = self.get_reference_values('author',
+          [i for ids in author_ids.values() for i in ids])
+        for record_id, ids in author_ids.items():
+          authors[record_id] = [names[i] for i in ids if i in names]
+        tag_ids = {}
+        for row in self.execute(sql.select([self._publicationtag.c.publication_id,
+            self._publicationtag.c.tag_id],
+            self._publicationtag.c.publication_id.in_(record_ids),
+            order_by=[self._publicationtag.c.publication_id,
+                      self._publicationtag.c.id])):
+          tag_ids.setdefault(row.publication_id, []).append(row.tag_id)
+        names = self.get_reference_values('tag',
+          [i for ids in tag_ids.values() for i in ids])
+        for record_id, ids in tag_ids.items():
+          tags[record_id] = [names[i] for i in ids if i in names]
+      languages = self.get_reference_values('language', language_ids)
+      return {'authors': authors, 'tags': tags, 'languages': languages,
+              'parents': self.get_parents(records)}
+
+    def get_theses_related(self, records):
+      """Fetch the abstracts of a page of theses with one query. Returns
+      the abstract texts keyed by thesis id."""
+      abstracts = {}
+      record_ids = [record.id for record in records]
+      if record_ids:
+        for row in self.execute(sql.select([self._thesisabstract.c.thesis_id,
+            self._thesisabstract.c.abstract],
+            self._thesisabstract.c.thesis_id.in_(record_ids),
+            order_by=[self._thesisabstract.c.thesis_id,
+                      self._thesisabstract.c.id])):
+          if row.abstract is not None:
+            abstracts.setdefault(row.thesis_id, []).append(row.abstract)
+      return {'abstracts': abstracts}
+
+    def map_publication(self, record, related):
+      metadata = {'title': [self.normalize_text(record.title)],
+                  'format': [u'digital'],
+                  'type': [record.child_type]}
+      if record.published is not None:
+        metadata['date'] = [unicode(record.published.strftime(
+          '%Y-%m-%dT%H:%M:%SZ'))]
+      parent = related['parents'].get(record.id)
+      if parent is not None and parent.publisher is not None:
+        metadata['publisher'] = [parent.publisher]
       if record.abstract is not None:
-        metadata += ', "description":["' + self.process_control_char_word_break(record.abstract) + '"]'
-      if(record.language_id is not None):
-        language = self.search_language(record.language_id)
-        if language is not None:
-          if language.language_tag is not None:
-            metadata += ', "language":["' + language.language_tag + '"]'
+        metadata['description'] = [self.normalize_text(record.abstract)]
+      if record.language_id is not None:
+        language_tag = related['languages'].get(record.language_id)
+        if language_tag is not None:
+          metadata['language'] = [language_tag]
       else:
-        metadata += ', "language":["en"]'
-      authors_ref = self.search_all_records_author(record.id)
-      for index in range(len(authors_ref)):
-        author = self.search_author(authors_ref[index].author_id)
-        if author is not None:
-            if index == 0:
-              metadata += ', "creator":["' + author.full_name + '"'
-              if len(authors_ref) == 1:
-                metadata += ']'
-            elif index == len(authors_ref) - 1:
-              metadata += ', "' + author.full_name + '"]'
-            else:
-              metadata += ', "' + author.full_name + '"'
-      tags_ref = self.search_all_tags(record.id)
-      for index in range(len(tags_ref)):
-        tag = self.seach_tag(tags_ref[index].tag_id)
-        if tag is not None:
-          if index == 0:
-             metadata += ', "subject":["' + tag.name + '"'
-             if len(tags_ref) == 1:
-              metadata += ']'
-          elif index == len(tags_ref) - 1:
-            metadata += ', "' + tag.name + '"]'
-          else:
-            metadata += ', "' + tag.name + '"'
-      return metadata + '}'
-
-    def get_thmetadata(self, record):
-      metadata = '{"type":["doctoral dissertation"], "format":["digital"]'
-      metadata += ', "title":["' + self.process_control_char_word_break(record.title) + '"]'
+        metadata['language'] = [u'en']
+      creators = related['authors'].get(record.id)
+      if creators:
+        metadata['creator'] = creators
+      subjects = related['tags'].get(record.id)
+      if subjects:
+        metadata['subject'] = subjects
+      return metadata
+
+    def map_thesis(self, record, related):
+      metadata = {'type': [u'doctoral dissertation'],
+                  'format': [u'digital'],
+                  'title': [self.normalize_text(record.title)]}
       if record.registration_date is not None:
-        metadata += ', "date":["' + record.registration_date.strftime('%Y-%m-%dT%H:%M:%SZ') + '"]'
-      author = self.search_author(record.id)
+        metadata['date'] = [unicode(record.registration_date.strftime(
+          '%Y-%m-%dT%H:%M:%SZ'))]
+      author = self.get_reference_values('author',
+        [record.author_id]).get(record.author_id)
       if author is not None:
-        metadata += ', "creator": ["' + author.full_name + '"]'
-      row = self._languages.select(self._languages.c.id == record.main_language_id).execute().fetchone()
-      if row is not None:
-        if row.language_tag is not None:
-          metadata += ', "language":["' + row.language_tag + '"]'
-      descriptions = self.search_all_thesis_abstract(record.id)
-      if descriptions is not None:
-        for index in range(len(descriptions)):
-          if index == 0:
-            metadata += ', "description":["' + self.process_control_char_word_break(descriptions[index].abstract) + '"'
-          else:
-            metadata += ', "' + self.process_control_char_word_break(descriptions[index].abstract) + '"'
-        metadata += ']'
-      return metadata + '}'
+        metadata['creator'] = [author]
+      language_tag = self.get_reference_values('language',
+        [record.main_language_id]).get(record.main_language_id)
+      if language_tag is not None:
+        metadata['language'] = [language_tag]
+      descriptions = related['abstracts'].get(record.id)
+      if descriptions:
+        metadata['description'] = [self.normalize_text(description)
+          for description in descriptions]
+      return metadata
 
     def get_app_label(self, tablename):
       return tablename.split('_')[0]
@@ -524,82 +890,290 @@ class SQLDatabase(object):
     def get_model_id(self, tablename):
       return tablename.split('_')[1]
 
+    def get_content_type_ids(self):
+      """Map labman table names to their django content type id."""
+      content_types = self._reference.get(('content_types', None))
+      if content_types is None:
+        content_types = {}
+        for row in self.execute(self._djangoContentType.select()):
+          content_types['%s_%s' % (row.app_label, row.model)] = row.id
+        self._reference.set(('content_types', None), content_types)
+      return content_types
+
+    def check_reference_cache(self):
+      """Empty the reference data cache when admin log entries were added
+      since it was filled, as labman logs every change to these tables."""
+      log_id = self.get_log_high_water()
+      if log_id != self._referenceLogId:
+        self._reference.clear()
+        self._referenceLogId = log_id
+
+    def get_reference_values(self, kind, ids):
+      """Look up the reference_columns value of a language, tag or author
+      by id. Ids missing from the cache are loaded with one query. Returns
+      a dict with the ids that exist."""
+      values = {}
+      missing = set()
+      for i in ids:
+        if i is None:
+          continue
+        value = self._reference.get((kind, i))
+        if value is None:
+          missing.add(i)
+        else:
+          values[i] = value
+      if missing:
+        table = self._db.tables[self.table_names.get(kind)]
+        column = table.c[self.reference_columns[kind]]
+        for row in self.execute(sql.select([table.c.id, column],
+            table.c.id.in_(sorted(missing)))):
+          if row[1] is not None:
+            values[row[0]] = row[1]
+            self._reference.set((kind, row[0]), row[1])
+      return values
+
+    def reference_cache_stats(self):
+      return self._reference.stats()
+
+    def get_identifier_filter(self):
+      """Return an IdentifierFilter over the OAI identifiers of all
+      records, rebuilt when admin log entries were added or the record
+      index changed since it was built."""
+      state = dict(self.execute(sql.select([self._state.c.name,
+        self._state.c.value], self._state.c.name.in_(
+          [u'index_built', u'index_log_id']))).fetchall())
+      key = (self.get_log_high_water(), state.get(u'index_built'),
+        state.get(u'index_log_id'))
+      filter_key, identifiers = self._identifiers
+      if identifiers is None or filter_key != key:
+        if state.get(u'index_built') is not None:
+          # the index also knows the deleted records
+          identifiers = IdentifierFilter([row[0] for row in self.execute(
+            sql.select([self._recordIndex.c.oai_id]))])
+        else:
+          identifiers = IdentifierFilter([u'%s/%s' % (row[0], row[1])
+            for table in (self._publication, self._thesis)
+            for row in self.execute(sql.select([table.c.id, table.c.slug]))])
+        self._identifiers = (key, identifiers)
+      return identifiers
+
+    def oai_may_exist(self, identifier):
+      """Return False when no record has this OAI identifier, True when
+      one probably has."""
+      return identifier in self.get_identifier_filter()
+
+    def get_parents(self, records):
+      """Load the parent rows of a page of publications, keyed by
+      publication id. Publications are grouped by child_type and every
+      group is loaded with one query that outer joins the child table and
+      the parent table. The rows also have the id of the parent row the
+      child refers to as parent_id, even when that row is missing."""
+      by_type = {}
+      for record in records:
+        by_type.setdefault(record.child_type, []).append(record.id)
+      parents = {}
+      for child_type, record_ids in by_type.items():
+        if child_type not in self.parent_tables:
+          continue
+        parent = self._db.tables[self.table_names.get(
+          self.parent_tables[child_type])]
+        if child_type in self.parent_refs:
+          key, column = self.parent_refs[child_type]
+          child = self._db.tables[self.table_names.get(key)]
+          parent_column = child.c[column]
+          source = child.outerjoin(parent,
+            parent_column == parent.c.publication_ptr_id)
+        else:
+          child = parent
+          parent_column = child.c.publication_ptr_id
+          source = child
+        for row in self.execute(sql.select([child.c.publication_ptr_id.label('record_id'),
+            parent_column.label('parent_id'), parent],
+            child.c.publication_ptr_id.in_(record_ids),
+            from_obj=[source])):
+          parents[row.record_id] = row
+      return parents
+
+    def _key_clause(self, table, object_ids):
+      # one IN clause per content type instead of one clause per key
+      return sql.or_(*[sql.and_(table.c.content_type_id == content_type,
+        table.c.object_id.in_(sorted(ids)))
+        for content_type, ids in object_ids.items()])
+
+    def refresh_latest_actions(self):
+      """Fold the admin log entries added since the last refresh into the
+      moai_latest_actions rollup. Returns the number of keys changed."""
+      # read from the primary, a replica may not have the latest rollup
+      primary = self.get_primary()
+      since = int(self.get_state(u'actions_log_id', 0, primary))
+      log_id = self.get_log_high_water(primary)
+      if log_id <= since:
+        return 0
+      latest = {}
+      for row in primary.execute(sql.select([self._djangoLog.c.content_type_id,
+          self._djangoLog.c.object_id,
+          sql.func.max(self._djangoLog.c.action_time)]).where(
+          self._djangoLog.c.id > since).where(
+          self._djangoLog.c.id <= log_id).where(
+          self._djangoLog.c.object_id != None).group_by(
+          self._djangoLog.c.content_type_id,
+          self._djangoLog.c.object_id)):
+        latest[(row[0], unicode(row[1]))] = row[2]
+
+      object_ids = {}
+      for content_type, object_id in latest:
+        object_ids.setdefault(content_type, set()).add(object_id)
+      if object_ids:
+        for row in primary.execute(sql.select([self._latestAction],
+            self._key_clause(self._latestAction, object_ids))):
+          key = (row.content_type_id, row.object_id)
+          if row.action_time >= latest[key]:
+            del latest[key]
+
+      connection = self._db.bind.connect()
+      transaction = connection.begin()
+      try:
+        for (content_type, object_id), action_time in latest.items():
+          connection.execute(self._latestAction.delete().where(sql.and_(
+            self._latestAction.c.content_type_id == content_type,
+            self._latestAction.c.object_id == object_id)))
+        if latest:
+          connection.execute(self._latestAction.insert(),
+            [{'content_type_id': content_type, 'object_id': object_id,
+              'action_time': action_time}
+             for (content_type, object_id), action_time in latest.items()])
+        self.set_state(u'actions_log_id', log_id, connection)
+        transaction.commit()
+      except sql.exc.IntegrityError:
+        # another process refreshed the same entries concurrently
+        transaction.rollback()
+      finally:
+        connection.close()
+      return len(latest)
+
+    def ensure_latest_actions(self):
+      """Refresh the moai_latest_actions rollup once for the request of
+      this thread, or on every call when no connection is open. When a
+      concurrent writer holds the database (sqlite reports "database is
+      locked") the refresh is skipped and the rollup is read as it is,
+      index_moai or a later request folds in the new entries."""
+      if getattr(self._local, 'connection', None) is not None:
+        if getattr(self._local, 'actions_refreshed', False):
+          return
+        self._local.actions_refreshed = True
+      try:
+        self.refresh_latest_actions()
+      except sql.exc.OperationalError:
+        pass
+
+    def rebuild_latest_actions(self):
+      self.execute(self._latestAction.delete())
+      self.execute(self._state.delete(self._state.c.name == u'actions_log_id'))
+      return self.refresh_latest_actions()
+
+    def get_latest_actions(self, keys):
+      """Return the latest admin log action_time for every (table name,
+      object id) key that has log entries. Looks the keys up in the
+      moai_latest_actions rollup, which is refreshed once per request."""
+      self.ensure_latest_actions()
+      content_types = self.get_content_type_ids()
+      object_ids = {}
+      for table, object_id in keys:
+        content_type = content_types.get(table)
+        if content_type is not None and object_id is not None:
+          object_ids.setdefault(content_type, set()).add(unicode(object_id))
+      if not object_ids:
+        return {}
+      tables = dict((value, key) for key, value in content_types.items())
+      latest = {}
+      for row in self.execute(sql.select([self._latestAction],
+          self._key_clause(self._latestAction, object_ids))):
+        latest[(tables[row.content_type_id], row.object_id)] = row.action_time
+      return latest
+
+    def _latest_of(self, record, keys, latest):
+      times = [latest[(table, unicode(object_id))] for table, object_id in keys
+        if (table, unicode(object_id)) in latest]
+      if times:
+        return max(times).replace(tzinfo=None)
+      return datetime.datetime(record.year, 1, 1)
+
+    def _in_chunks(self, records, size=200):
+      records = list(records)
+      for start in xrange(0, len(records), size):
+        yield records[start:start + size]
+
+    def get_pubmodified_dates(self, records):
+      """Compute the datestamps of many publications at once, keyed by
+      publication id. Checks the publication, its parent, language,
+      authors and tags."""
+      modified = {}
+      for chunk in self._in_chunks(records):
+        record_ids = [record.id for record in chunk]
+        parents = self.get_parents(chunk)
+        authors = {}
+        for row in self.execute(sql.select([self._publicationauthor.c.publication_id,
+            self._publicationauthor.c.author_id],
+            self._publicationauthor.c.publication_id.in_(record_ids))):
+          authors.setdefault(row[0], []).append(row[1])
+        tags = {}
+        for row in self.execute(sql.select([self._publicationtag.c.publication_id,
+            self._publicationtag.c.tag_id],
+            self._publicationtag.c.publication_id.in_(record_ids))):
+          tags.setdefault(row[0], []).append(row[1])
+
+        record_keys = {}
+        for record in chunk:
+          keys = [(self.table_names.get('publication'), record.id),
+                  ('publications_' + record.child_type.lower(),
+                   parents[record.id].parent_id
+                   if record.id in parents else None),
+                  (self.table_names.get('language'), record.language_id or 1)]
+          keys.extend([(self.table_names.get('author'), author_id)
+            for author_id in authors.get(record.id, [])])
+          keys.extend([(self.table_names.get('tag'), tag_id)
+            for tag_id in tags.get(record.id, [])])
+          record_keys[record.id] = [key for key in keys if key[1] is not None]
+
+        latest = self.get_latest_actions(
+          [key for keys in record_keys.values() for key in keys])
+        for record in chunk:
+          modified[record.id] = self._latest_of(record,
+            record_keys[record.id], latest)
+      return modified
+
+    def get_thmodified_dates(self, records):
+      """Compute the datestamps of many theses at once, keyed by thesis
+      id. Checks the thesis, its language, author and abstracts."""
+      modified = {}
+      for chunk in self._in_chunks(records):
+        abstracts = {}
+        for row in self.execute(sql.select([self._thesisabstract.c.thesis_id,
+            self._thesisabstract.c.id], self._thesisabstract.c.thesis_id.in_(
+            [record.id for record in chunk]))):
+          abstracts.setdefault(row[0], []).append(row[1])
+
+        record_keys = {}
+        for record in chunk:
+          keys = [(self.table_names.get('thesis'), record.id),
+                  (self.table_names.get('language'), record.main_language_id),
+                  (self.table_names.get('author'), record.author_id)]
+          keys.extend([(self.table_names.get('abstract'), abstract_id)
+            for abstract_id in abstracts.get(record.id, [])])
+          record_keys[record.id] = [key for key in keys if key[1] is not None]
+
+        latest = self.get_latest_actions(
+          [key for keys in record_keys.values() for key in keys])
+        for record in chunk:
+          modified[record.id] = self._latest_of(record,
+            record_keys[record.id], latest)
+      return modified
+
     def get_pubmodified_date(self, record):
-      #tables to check: publication, language, tag, collectionpublication, person
-      
-      ids = [[] for i in xrange(5)]
-      ids[0].append(record.id)
-      dc_type_id = None
-      dc_type = self.get_parent_type(record.child_type, record.id)
-      if dc_type is not None:
-        ids[1].append(dc_type.publication_ptr_id)
-      ids[2].append(record.language_id)
-      if ids[2][0] is None:
-        ids[2][0] = 1
-      authors = self.search_all_records_author(record.id)
-      for author in authors:
-        ids[3].append(author.author_id)
-      tags = self.search_all_tags(record.id)
-      for tag in tags:
-        ids[4].append(tag.tag_id)
-      
-      tables = []
-      tables.append(self.table_names.get('publication'))
-      tables.append('publications_' + record.child_type.lower())
-      tables.append(self.table_names.get('language'))
-      tables.append(self.table_names.get('author'))
-      tables.append(self.table_names.get('tag'))
-
-      logs_query = sql.select([self._djangoLog.c.action_time],
-        from_obj=[self._djangoLog]).order_by(sql.desc(self._djangoLog.c.action_time))
-      where_clauses = []
-
-      for index in range(len(tables)):
-        content_type = self.search_content_type(self.get_app_label(tables[index]), self.get_model_id(tables[index]))
-        if content_type is not None:
-          for j_index in range(len(ids[index])):
-            where_clauses.append(sql.and_(
-              self._djangoLog.c.content_type_id == content_type.id, self._djangoLog.c.object_id == unicode(ids[index][j_index])))
-      logs_query.append_whereclause(sql.or_(*where_clauses))
-      row = logs_query.execute().fetchone()
-      if row is not None:
-        return row[0].replace(tzinfo=None)
-      else:
-        return datetime.datetime(record.year, 1, 1)
+      return self.get_pubmodified_dates([record])[record.id]
 
     def get_thmodified_date(self, record):
-      #tables to check: thesis, language, person, abstract
-      
-      ids = [[] for i in xrange(4)]
-      ids[0].append(record.id)
-      ids[1].append(record.main_language_id)
-      ids[2].append(record.author_id)
-      abstracts = self.search_all_thesis_abstract(record.id)
-      for abstract in abstracts:
-        ids[3].append(abstract.id)
-
-      tables = []
-      tables.append(self.table_names.get('thesis'))
-      tables.append(self.table_names.get('language'))
-      tables.append(self.table_names.get('author'))
-      tables.append(self.table_names.get('abstract'))
-
-      logs_query = sql.select([self._djangoLog.c.action_time],
-        from_obj=[self._djangoLog]).order_by(sql.desc(self._djangoLog.c.action_time))
-      where_clauses = []
-
-      for index in range(len(tables)):
-        content_type = self.search_content_type(self.get_app_label(tables[index]), self.get_model_id(tables[index]))
-        if content_type is not None:
-          for j_index in range(len(ids[index])):
-            where_clauses.append(sql.and_(
-              self._djangoLog.c.content_type_id == content_type.id, self._djangoLog.c.object_id == unicode(ids[index][j_index])))
-      logs_query.append_whereclause(sql.or_(*where_clauses))
-      row = logs_query.execute().fetchone()
-      if row is not None:
-        return row[0].replace(tzinfo=None)
-      else:
-        return datetime.datetime(record.year, 1, 1)
+      return self.get_thmodified_dates([record])[record.id]
 
     def generate_json(self, r_id, delete, modified_timestamp, metadata, sets):
       return {  
@@ -610,6 +1184,633 @@ class SQLDatabase(object):
                 'sets': sets
               }
 
+    def get_state(self, name, default=None, connection=None):
+      row = (connection or self).execute(sql.select([self._state.c.value],
+        self._state.c.name == name)).fetchone()
+      if row is None:
+        return default
+      return row[0]
+
+    def set_state(self, name, value, connection=None):
+      connection = connection or self._db.bind
+      connection.execute(self._state.delete(self._state.c.name == name))
+      connection.execute(self._state.insert(), name=name, value=unicode(value))
+
+    def get_log_high_water(self, connection=None):
+      return (connection or self).execute(sql.select([sql.func.max(self._djangoLog.c.id)])
+        ).fetchone()[0] or 0
+
+    def index_is_built(self):
+      return self.get_state(u'index_built') is not None
+
+    def get_index_entries(self, record_type, records):
+      if record_type == u'thesis':
+        modified = self.get_thmodified_dates(records)
+      else:
+        modified = self.get_pubmodified_dates(records)
+      entries = []
+      for record in records:
+        if record_type == u'thesis':
+          set_spec = self.get_thesis_setspec()[0]
+        else:
+          set_spec = record.child_type
+        entries.append({'record_type': record_type,
+                        'record_id': record.id,
+                        'oai_id': u'%s/%s' % (record.id, record.slug),
+                        'set_spec': set_spec,
+                        'modified': modified[record.id],
+                        'deleted': False})
+      return entries
+
+    def _source_table(self, record_type):
+      if record_type == u'thesis':
+        return self._thesis
+      return self._publication
+
+    def _header_select(self, record_type):
+      table = self._source_table(record_type)
+      return sql.select([table.c[name]
+        for name in self.header_columns[record_type]])
+
+    def _to_ids(self, values):
+      ids = set()
+      for value in values:
+        try:
+          ids.add(int(value))
+        except (TypeError, ValueError):
+          pass
+      return ids
+
+    def _select_ids(self, column, where_column, ids):
+      if not ids:
+        return set()
+      return set(row[0] for row in self.execute(sql.select([column],
+        where_column.in_(list(ids)))))
+
+    def get_records_touched(self, since_log_id, until_log_id):
+      """Return the (record_type, record_id) pairs whose datestamp may
+      have changed because of admin log entries in the given id range."""
+      tables = {}
+      for row in self.execute(self._djangoContentType.select()):
+        tables[row.id] = '%s_%s' % (row.app_label, row.model)
+      objects = {}
+      for row in self.execute(sql.select([self._djangoLog.c.content_type_id,
+          self._djangoLog.c.object_id]).where(
+          self._djangoLog.c.id > since_log_id).where(
+          self._djangoLog.c.id <= until_log_id)):
+        table = tables.get(row.content_type_id)
+        if table is not None:
+          objects.setdefault(table, set()).add(row.object_id)
+
+      publications = set()
+      theses = set()
+      for table, object_ids in objects.items():
+        ids = self._to_ids(object_ids)
+        if table == self.table_names.get('publication'):
+          publications |= ids
+        elif table == self.table_names.get('thesis'):
+          theses |= ids
+        elif table == self.table_names.get('abstract'):
+          theses |= self._select_ids(self._thesisabstract.c.thesis_id,
+            self._thesisabstract.c.id, ids)
+        elif table == self.table_names.get('language'):
+          publications |= self._select_ids(self._publication.c.id,
+            self._publication.c.language_id, ids)
+          if 1 in ids:
+            # publications without language count as language 1
+            publications |= set(row[0] for row in self.execute(sql.select(
+              [self._publication.c.id],
+              self._publication.c.language_id == None)))
+          theses |= self._select_ids(self._thesis.c.id,
+            self._thesis.c.main_language_id, ids)
+        elif table == self.table_names.get('author'):
+          publications |= self._select_ids(
+            self._publicationauthor.c.publication_id,
+            self._publicationauthor.c.author_id, ids)
+          theses |= self._select_ids(self._thesis.c.id,
+            self._thesis.c.author_id, ids)
+        elif table == self.table_names.get('tag'):
+          publications |= self._select_ids(
+            self._publicationtag.c.publication_id,
+            self._publicationtag.c.tag_id, ids)
+        elif table.startswith('publications_'):
+          # child tables are logged against the parent row id
+          publications |= ids
+          for child_type, (key, column) in self.parent_refs.items():
+            if table == 'publications_' + child_type.lower():
+              child = self._db.tables[self.table_names.get(key)]
+              publications |= self._select_ids(child.c.publication_ptr_id,
+                child.c[column], ids)
+      return set([(u'publication', i) for i in publications] +
+                 [(u'thesis', i) for i in theses])
+
+    def rebuild_index(self):
+      """Recompute the record index from scratch, returns the number of
+      indexed records."""
+      self.check_reference_cache()
+      log_id = self.get_log_high_water()
+      entries = []
+      for record_type in (u'publication', u'thesis'):
+        entries.extend(self.get_index_entries(record_type,
+          self.execute(self._header_select(record_type)).fetchall()))
+      self.execute(self._recordIndex.delete())
+      if entries:
+        self.execute(self._recordIndex.insert(), entries)
+      self.set_state(u'index_log_id', log_id)
+      self.set_state(u'index_built',
+        datetime.datetime.utcnow().isoformat())
+      self.rebuild_day_counts()
+      return len(entries)
+
+    def refresh_index(self):
+      """Bring the record index up to date with the labman tables, only
+      recomputing records that are new or touched by admin log entries
+      since the last refresh. Returns the number of changed entries."""
+      if not self.index_is_built():
+        return self.rebuild_index()
+      self.check_reference_cache()
+      since = int(self.get_state(u'index_log_id', 0))
+      log_id = self.get_log_high_water()
+      touched = self.get_records_touched(since, log_id)
+      now = datetime.datetime.utcnow()
+
+      indexed = {}
+      for row in self.execute(sql.select([self._recordIndex.c.record_type,
+          self._recordIndex.c.record_id,
+          self._recordIndex.c.deleted])):
+        indexed[(row.record_type, row.record_id)] = row.deleted
+
+      changed = []
+      for record_type in (u'publication', u'thesis'):
+        table = self._source_table(record_type)
+        existing = set(row[0] for row in
+          self.execute(sql.select([table.c.id])))
+        update_ids = [record_id for record_id in existing
+          if indexed.get((record_type, record_id)) is not False
+          or (record_type, record_id) in touched]
+        for start in xrange(0, len(update_ids), 500):
+          changed.extend(self.get_index_entries(record_type,
+            self.execute(self._header_select(record_type).where(
+              table.c.id.in_(update_ids[start:start + 500]))).fetchall()))
+        for (indexed_type, record_id), deleted in indexed.items():
+          if (indexed_type == record_type and not deleted
+              and record_id not in existing):
+            changed.append({'record_type': record_type,
+                            'record_id': record_id,
+                            'deleted': True,
+                            'modified': now})
+
+      for entry in changed:
+        if entry['deleted']:
+          self.execute(self._recordIndex.update().where(sql.and_(
+            self._recordIndex.c.record_type == entry['record_type'],
+            self._recordIndex.c.record_id == entry['record_id'])),
+            deleted=True, modified=entry['modified'])
+        else:
+          self.execute(self._recordIndex.delete().where(sql.and_(
+            self._recordIndex.c.record_type == entry['record_type'],
+            self._recordIndex.c.record_id == entry['record_id'])))
+          self.execute(self._recordIndex.insert(), entry)
+      self.set_state(u'index_log_id', log_id)
+      if changed or self.get_state(u'day_counts_built') is None:
+        self.rebuild_day_counts()
+      return len(changed)
+
+    def rebuild_day_counts(self):
+      """Recount the indexed records per set and day with one grouped
+      query over moai_records."""
+      index = self._recordIndex
+      day = day_of(self._db.bind, index.c.modified)
+      connection = self._db.bind.connect()
+      transaction = connection.begin()
+      try:
+        connection.execute(self._dayCount.delete())
+        connection.execute(self._dayCount.insert().from_select(
+          ['set_spec', 'day', 'records'],
+          sql.select([index.c.set_spec, day, sql.func.count()]).group_by(
+            index.c.set_spec, day)))
+        self.set_state(u'day_counts_built',
+          datetime.datetime.utcnow().isoformat(), connection)
+        transaction.commit()
+      finally:
+        connection.close()
+
+    def get_set_filter(self, needed_sets=None, disallowed_sets=None,
+                       allowed_sets=None):
+      """Translate the set filters of oai_query into (include, exclude),
+      the set specs a record may and may not have. include is None when
+      any set spec will do. Every labman record is in exactly one set,
+      which has to be one of the needed sets and one of the allowed sets
+      and may not be a disallowed set."""
+      include = None
+      if needed_sets:
+        include = set(needed_sets)
+      if allowed_sets:
+        if include is None:
+          include = set(allowed_sets)
+        else:
+          include &= set(allowed_sets)
+      exclude = set(disallowed_sets or [])
+      if include is not None:
+        return sorted(include - exclude), []
+      return None, sorted(exclude)
+
+    def _in_sets(self, set_spec, set_filter):
+      include, exclude = set_filter
+      return ((include is None or set_spec in include)
+              and set_spec not in exclude)
+
+    def _record_types(self, set_filter):
+      # the record types that have a set passing set_filter
+      include = set_filter[0]
+      thesis_set = self.get_thesis_setspec()[0]
+      record_types = []
+      if include is None or [set_spec for set_spec in include
+          if set_spec != thesis_set]:
+        record_types.append(u'publication')
+      if self._in_sets(thesis_set, set_filter):
+        record_types.append(u'thesis')
+      return record_types
+
+    def _set_clause(self, column, set_filter):
+      include, exclude = set_filter
+      if include is not None:
+        return column.in_(include)
+      if exclude:
+        return sql.not_(column.in_(exclude))
+      return None
+
+    def oai_count(self, needed_sets=None, disallowed_sets=None,
+                  allowed_sets=None, from_date=None, until_date=None):
+      """Return the number of records oai_query lists for these
+      arguments, or None when it can not be told without running it.
+      Uses moai_day_counts, which is only kept for the record index."""
+      if (not self.index_is_built() or
+          self.get_state(u'day_counts_built') is None):
+        return None
+      if until_date is None or until_date > datetime.datetime.utcnow():
+        until_date = datetime.datetime.utcnow()
+      index = self._recordIndex
+      counts = self._dayCount
+      set_filter = self.get_set_filter(needed_sets, disallowed_sets,
+        allowed_sets)
+      if set_filter[0] == []:
+        return 0
+
+      def count_days(first_day, last_day):
+        query = sql.select([sql.func.sum(counts.c.records)],
+          counts.c.day <= last_day)
+        if first_day is not None:
+          query.append_whereclause(counts.c.day >= first_day)
+        set_clause = self._set_clause(counts.c.set_spec, set_filter)
+        if set_clause is not None:
+          query.append_whereclause(set_clause)
+        return self.execute(query).scalar() or 0
+
+      def count_range(start, end):
+        query = sql.select([sql.func.count()], sql.and_(
+          index.c.modified >= start, index.c.modified < end))
+        set_clause = self._set_clause(index.c.set_spec, set_filter)
+        if set_clause is not None:
+          query.append_whereclause(set_clause)
+        return self.execute(query).scalar()
+
+      return count_window(from_date, until_date, count_days, count_range)
+
+    def get_page_records(self, entries):
+      """Load the labman rows of a page of index entries, one query per
+      record type, keyed by (record_type, record_id)."""
+      records = {}
+      for record_type in (u'publication', u'thesis'):
+        record_ids = [entry['record_id'] for entry in entries
+          if entry['record_type'] == record_type and not entry['deleted']]
+        if record_ids:
+          table = self._source_table(record_type)
+          statement = self.get_statement(('page', record_type),
+            lambda: table.select(table.c.id.in_(
+              sql.bindparam('ids', expanding=True))))
+          for record in self.execute_statement(statement,
+              {'ids': record_ids}):
+            records[(record_type, record.id)] = record
+      return records
+
+    def get_indexed_record(self, entry, record, related):
+      if record is None:
+        return self.generate_json(entry['oai_id'], True, entry['modified'],
+          {}, [entry['set_spec']])
+      mapper = getattr(self,
+        self.record_mappers.get(entry['set_spec'], 'map_publication'))
+      metadata = mapper(record, related)
+      return self.generate_json(entry['oai_id'], False, entry['modified'],
+        metadata, [entry['set_spec']])
+
+    def get_record(self, oai_id):
+      """Look up one record by its id/slug OAI identifier with a primary
+      key query, returning the dict oai_query yields for it, or None when
+      the id does not exist or has another slug."""
+      try:
+        record_id, slug = oai_id.split(u'/', 1)
+        record_id = int(record_id)
+      except ValueError:
+        return None
+      self.check_reference_cache()
+      if self.index_is_built():
+        index = self._recordIndex
+        statement = self.get_statement(('record', 'index'),
+          lambda: index.select(index.c.oai_id == sql.bindparam('oai_id')))
+        entry = self.execute_statement(statement,
+          {'oai_id': oai_id}).fetchone()
+        if entry is None:
+          return None
+        candidates = [(entry['record_type'], entry)]
+      else:
+        # publications and theses have their own ids, the slug tells
+        # which of the two is meant
+        candidates = [(u'publication', None), (u'thesis', None)]
+      for record_type, entry in candidates:
+        record = None
+        if entry is None or not entry['deleted']:
+          table = self._source_table(record_type)
+          statement = self.get_statement(('record', record_type),
+            lambda: table.select(table.c.id == sql.bindparam('id')))
+          record = self.execute_statement(statement,
+            {'id': record_id}).fetchone()
+        if entry is None:
+          if record is None or record.slug != slug:
+            continue
+          entry = self.get_index_entries(record_type, [record])[0]
+        if record_type == u'thesis':
+          related = self.get_theses_related([record] if record else [])
+        else:
+          related = self.get_publications_related([record] if record else [])
+        return self.get_indexed_record(entry, record, related)
+      return None
+
+    def iter_lazy_entries(self, set_filter=(None, []), from_date=None,
+                          until_date=None, identifier=None, seek=None,
+                          chunk_size=20):
+      """Stream publications and then theses in id order, computing the
+      datestamps of chunk_size rows at a time and yielding (index entry,
+      labman row) pairs for the records that match the dates and the
+      get_set_filter set_filter. Nothing is computed for rows the caller
+      does not consume, and a table none of whose sets pass the filter
+      is not queried. The rows only have the header_columns."""
+      position = self.parse_seek_key(seek)
+      # fold in new admin log entries now, so computing the datestamps
+      # does not write while the table scan is open
+      self.ensure_latest_actions()
+      for record_type in (u'publication', u'thesis'):
+        if position is not None and record_type < position[1]:
+          continue
+        if record_type not in self._record_types(set_filter):
+          continue
+        table = self._source_table(record_type)
+        params = {}
+        include, exclude = set_filter
+        if record_type == u'publication' and include is not None:
+          params['sets'] = [set_spec for set_spec in include
+            if set_spec != self.get_thesis_setspec()[0]]
+        elif record_type == u'publication' and exclude:
+          params['not_sets'] = exclude
+        if identifier is not None:
+          try:
+            record_id, slug = identifier.split(u'/', 1)
+            params['id'] = int(record_id)
+            params['slug'] = slug
+          except ValueError:
+            return
+        if position is not None and record_type == position[1]:
+          params['after'] = position[2]
+
+        def build():
+          query = self._header_select(record_type).order_by(
+            sql.asc(table.c.id))
+          if 'sets' in params:
+            query.append_whereclause(table.c.child_type.in_(
+              sql.bindparam('sets', expanding=True)))
+          if 'not_sets' in params:
+            query.append_whereclause(sql.not_(table.c.child_type.in_(
+              sql.bindparam('not_sets', expanding=True))))
+          if 'id' in params:
+            query.append_whereclause(table.c.id == sql.bindparam('id'))
+            query.append_whereclause(table.c.slug == sql.bindparam('slug'))
+          if 'after' in params:
+            query.append_whereclause(table.c.id > sql.bindparam('after'))
+          return query.execution_options(stream_results=True)
+        statement = self.get_statement(
+          ('lazy', record_type) + tuple(sorted(params)), build)
+        result = self.execute_statement(statement, params)
+        try:
+          while True:
+            rows = result.fetchmany(chunk_size)
+            if not rows:
+              break
+            for entry, row in zip(self.get_index_entries(record_type, rows),
+                                  rows):
+              if entry['modified'] > until_date:
+                continue
+              if from_date is not None and entry['modified'] < from_date:
+                continue
+              yield entry, row
+        finally:
+          result.close()
+
+    def oai_seek_key(self, record):
+      """Return the position of a record in the order oai_query lists
+      records in, which can be passed as seek to continue after it."""
+      if record['sets'] == self.get_thesis_setspec():
+        record_type = u'thesis'
+      else:
+        record_type = u'publication'
+      return u'%s,%s,%s' % (record['modified'].strftime('%Y-%m-%dT%H:%M:%S.%f'),
+        record_type, record['id'].split('/')[0])
+
+    def parse_seek_key(self, seek):
+      try:
+        modified, record_type, record_id = seek.split(',')
+        return (datetime.datetime.strptime(modified, '%Y-%m-%dT%H:%M:%S.%f'),
+                unicode(record_type), int(record_id))
+      except (AttributeError, ValueError):
+        return None
+
+    def _year_start(self, year):
+      if self._db.bind.dialect.name == 'sqlite':
+        # sqlite compares datetimes as text, so use the format the
+        # DateTime type stores and binds, with microseconds
+        return sql.type_coerce(
+          sql.cast(year, sql.String) + u'-01-01 00:00:00.000000',
+          sql.DateTime)
+      return sql.cast(sql.cast(year, sql.String) + u'-01-01', sql.DateTime)
+
+    def _latest_action_for(self, table, keys, year):
+      """Build the datestamp of a record as a SQL expression: the latest
+      moai_latest_actions time of the (content type id, object id
+      expression) keys, or the first day of year."""
+      latest = self._latestAction
+      clauses = []
+      for content_type, object_id in keys:
+        if content_type is None:
+          continue
+        if isinstance(object_id, sql.sql.expression.Select):
+          match = latest.c.object_id.in_(object_id.correlate(table))
+        else:
+          match = latest.c.object_id == sql.cast(object_id, sql.String)
+        clauses.append(sql.and_(latest.c.content_type_id == content_type,
+                                match))
+      action_time = sql.select([sql.func.max(latest.c.action_time)],
+        sql.or_(*clauses)).correlate(table).as_scalar()
+      return sql.func.coalesce(action_time, self._year_start(year),
+        type_=sql.DateTime)
+
+    def get_live_records(self):
+      """Return the publications and the theses as relations with the
+      columns of moai_records, keyed by record type, computing the
+      datestamps in the database from the moai_latest_actions rollup. The
+      relations are built once for every set of content type ids."""
+      self.ensure_latest_actions()
+      content_types = self.get_content_type_ids()
+
+      def build():
+        text = lambda column: sql.cast(column, sql.String)
+
+        publication = self._publication
+        keys = [(content_types.get(self.table_names.get('publication')),
+                 publication.c.id),
+                (content_types.get(self.table_names.get('language')),
+                 sql.func.coalesce(publication.c.language_id, 1)),
+                (content_types.get(self.table_names.get('author')),
+                 sql.select([text(self._publicationauthor.c.author_id)],
+                   self._publicationauthor.c.publication_id == publication.c.id)),
+                (content_types.get(self.table_names.get('tag')),
+                 sql.select([text(self._publicationtag.c.tag_id)],
+                   self._publicationtag.c.publication_id == publication.c.id))]
+        for publication_set in self.sets[:8]:
+          child_type = publication_set.get('id')
+          if child_type in self.parent_refs:
+            key, column = self.parent_refs[child_type]
+            child = self._db.tables[self.table_names.get(key)]
+            parent_column = child.c[column]
+          else:
+            child = self._db.tables['publications_' + child_type.lower()]
+            parent_column = child.c.publication_ptr_id
+          keys.append((content_types.get('publications_' + child_type.lower()),
+            sql.select([text(parent_column)], sql.and_(
+              publication.c.child_type == child_type,
+              child.c.publication_ptr_id == publication.c.id))))
+        publications = sql.select([
+          sql.literal(u'publication', sql.Unicode).label('record_type'),
+          publication.c.id.label('record_id'),
+          (text(publication.c.id) + u'/' + publication.c.slug).label('oai_id'),
+          publication.c.child_type.label('set_spec'),
+          self._latest_action_for(publication, keys,
+            publication.c.year).label('modified'),
+          sql.literal(False, sql.Boolean).label('deleted')])
+
+        thesis = self._thesis
+        keys = [(content_types.get(self.table_names.get('thesis')),
+                 thesis.c.id),
+                (content_types.get(self.table_names.get('language')),
+                 thesis.c.main_language_id),
+                (content_types.get(self.table_names.get('author')),
+                 thesis.c.author_id),
+                (content_types.get(self.table_names.get('abstract')),
+                 sql.select([text(self._thesisabstract.c.id)],
+                   self._thesisabstract.c.thesis_id == thesis.c.id))]
+        theses = sql.select([
+          sql.literal(u'thesis', sql.Unicode).label('record_type'),
+          thesis.c.id.label('record_id'),
+          (text(thesis.c.id) + u'/' + thesis.c.slug).label('oai_id'),
+          sql.literal(self.get_thesis_setspec()[0], sql.Unicode).label(
+            'set_spec'),
+          self._latest_action_for(thesis, keys, thesis.c.year).label('modified'),
+          sql.literal(False, sql.Boolean).label('deleted')])
+
+        return {u'publication': publications.alias('live_publications'),
+                u'thesis': theses.alias('live_theses')}
+      return self.get_statement(('live_records',
+        tuple(sorted(content_types.items()))), build)
+
+    def get_live_entries(self, set_filter=(None, []), from_date=None,
+                         until_date=None, seek=None, offset=0, batch_size=20):
+      """Select a batch from the live publications and theses in
+      datestamp order. Both are queried side by side for their first
+      offset + batch_size records, which are merged in the order of the
+      index."""
+      sources = self.get_live_records()
+
+      def query(record_type):
+        type_filter = set_filter
+        if record_type == u'thesis':
+          # all theses are in one set, which passed the filter
+          type_filter = (None, [])
+        def run():
+          statement, params = self.get_records_query(sources[record_type],
+            type_filter, from_date, until_date, None, seek, 0,
+            offset + batch_size)
+          return [((row.modified, row.record_type, row.record_id), row)
+            for row in self.execute_statement(statement, params)]
+        return run
+      results = self.run_concurrently([query(record_type)
+        for record_type in self._record_types(set_filter)])
+      entries = [row for key, row in heapq.merge(*results)]
+      return entries[offset:offset + batch_size]
+
+    def get_records_query(self, records, set_filter=(None, []),
+                          from_date=None, until_date=None, identifier=None,
+                          seek=None, offset=0, batch_size=20):
+      """Select a batch from moai_records or the live relation in
+      datestamp order, applying the oai_query filters, with the sets as
+      a get_set_filter set_filter. Returns the
+      statement, which is built once for every combination of filters,
+      and the values of its bind parameters."""
+      params = {'until': until_date, 'offset': offset, 'limit': batch_size}
+      if from_date is not None:
+        params['from'] = from_date
+      if identifier is not None:
+        params['identifier'] = identifier
+      include, exclude = set_filter
+      if include is not None:
+        params['sets'] = include
+      elif exclude:
+        params['not_sets'] = exclude
+      position = self.parse_seek_key(seek)
+      if position is not None:
+        (params['seek_modified'], params['seek_type'],
+         params['seek_id']) = position
+
+      def build():
+        query = sql.select([records],
+          order_by=[sql.asc(records.c.modified),
+                    sql.asc(records.c.record_type),
+                    sql.asc(records.c.record_id)])
+        query.append_whereclause(records.c.modified <= sql.bindparam('until'))
+        if 'from' in params:
+          query.append_whereclause(records.c.modified >= sql.bindparam('from'))
+        if 'identifier' in params:
+          query.append_whereclause(
+            records.c.oai_id == sql.bindparam('identifier'))
+        if 'sets' in params:
+          query.append_whereclause(records.c.set_spec.in_(
+            sql.bindparam('sets', expanding=True)))
+        if 'not_sets' in params:
+          query.append_whereclause(sql.not_(records.c.set_spec.in_(
+            sql.bindparam('not_sets', expanding=True))))
+        if 'seek_id' in params:
+          # continue after the last record of the previous batch, the
+          # leading range predicate lets the database use the order index
+          modified = sql.bindparam('seek_modified', type_=sql.DateTime)
+          record_type = sql.bindparam('seek_type', type_=sql.Unicode)
+          query.append_whereclause(records.c.modified >= modified)
+          query.append_whereclause(sql.or_(
+            records.c.modified > modified,
+            records.c.record_type > record_type,
+            sql.and_(records.c.record_type == record_type,
+                     records.c.record_id > sql.bindparam('seek_id'))))
+        return query.offset(sql.bindparam('offset')).limit(
+          sql.bindparam('limit'))
+      return self.get_statement(('records', records) +
+        tuple(sorted(params)), build), params
+
     def oai_query(self,
                   offset=0,
                   batch_size=20,
@@ -618,7 +1819,9 @@ class SQLDatabase(object):
                   allowed_sets=None,
                   from_date=None,
                   until_date=None,
-                  identifier=None):
+                  identifier=None,
+                  seek=None,
+                  with_metadata=True):
 
         """needed_sets = needed_sets or []
         disallowed_sets = disallowed_sets or []
@@ -673,70 +1876,81 @@ class SQLDatabase(object):
                    'sets': self.get_setrefs(row.record_id)
                    }"""
 
-        publicationQuery = self._publication.select()
-        thesisQuery = self._thesis.select()
-        record_id = None
-        slug = None
-        search_thesis = True
-        
-        if identifier is not None:
-          try:
-            splitter = identifier.index('/')
-            record_id = int(identifier[:splitter])
-            slug = identifier[splitter + 1:]
-          except ValueError:
-            pass
-          publicationQuery.append_whereclause(self._publication.c.id == record_id)
-          thesisQuery.append_whereclause(self._thesis.c.id == record_id)
-
         if until_date == None or until_date > datetime.datetime.utcnow():
           until_date = datetime.datetime.utcnow()
 
-        if needed_sets:
-          publicationQuery.append_whereclause(self._publication.c.child_type.in_(needed_sets))
-          if self.sets[8].get('id') not in needed_sets:
-            search_thesis = False
-
-        totalrows = 0        
-        pub_records = 0
-        publications = []
-
-        for row in publicationQuery.distinct().order_by(sql.asc(self._publication.c.id)).execute().fetchall():
-          modified_timestamp = self.get_pubmodified_date(row)
-          if from_date is not None:
-            if modified_timestamp >= from_date and modified_timestamp <= until_date:
-                totalrows += 1
-                publications.append({'record': row, 'modified': modified_timestamp})
-          elif modified_timestamp <= until_date:
-                totalrows += 1
-                publications.append({'record': row, 'modified': modified_timestamp})
-
-        if offset < totalrows:
-          th_offset = 0
-          index = offset
-          while index < len(publications) and pub_records < batch_size:
-            yield self.generate_json(str(publications[index].get('record').id)
-              + '/' + publications[index].get('record').slug, False,
-              publications[index].get('modified'),
-              json.loads(self.get_pubmetadata(publications[index].get('record'))), 
-              self.get_publication_setspec(publications[index].get('record').child_type))
-            index += 1
-            pub_records += 1
-        else:
-          th_offset = offset - totalrows
-        if not search_thesis:
-          th_limit = 0
+        set_filter = self.get_set_filter(needed_sets, disallowed_sets,
+          allowed_sets)
+        if set_filter[0] == []:
+          # the set filters exclude each other
+          return
+
+        if identifier is not None:
+          record = self.get_record(identifier)
+          if (record is None or offset > 0
+              or record['modified'] > until_date
+              or (from_date is not None and record['modified'] < from_date)
+              or not self._in_sets(record['sets'][0], set_filter)):
+            return
+          yield record
+          return
+
+        self.check_reference_cache()
+        if self.index_is_built():
+          if self.parse_seek_key(seek) is not None:
+            offset = 0
+          statement, params = self.get_records_query(self._recordIndex,
+            set_filter, from_date, until_date, identifier, seek, offset,
+            batch_size)
+          entries = self.execute_statement(statement, params).fetchall()
+        elif from_date is not None:
+          if self.parse_seek_key(seek) is not None:
+            offset = 0
+          entries = self.get_live_entries(set_filter, from_date, until_date,
+            seek, offset, batch_size)
         else:
-          th_limit = batch_size - pub_records
-        
-        #TODO change the zero default offset for real value.
-        for row in thesisQuery.distinct().offset(th_offset).limit(th_limit).execute():
-          modified_timestamp = self.get_thmodified_date(row)
-          oai_set = self.get_thesis_setspec()
-          if from_date is not None:
-            if modified_timestamp >= from_date and modified_timestamp <= until_date:
-              yield self.generate_json(str(row.id) + '/' + row.slug, False,
-                self.get_thmodified_date(row), json.loads(self.get_thmetadata(row)), oai_set)
-          elif modified_timestamp <= until_date:
-            yield self.generate_json(str(row.id) + '/' + row.slug, False,
-              self.get_thmodified_date(row), json.loads(self.get_thmetadata(row)), oai_set)
\ No newline at end of file
+          # without a from date nearly every record matches, so walk the
+          # labman tables in id order and stop as soon as the batch is
+          # full instead of computing and sorting all datestamps
+          if self.parse_seek_key(seek) is not None:
+            offset = 0
+          entries = []
+          for entry, row in self.iter_lazy_entries(set_filter, from_date,
+              until_date, identifier, seek, chunk_size=batch_size or 1):
+            if offset > 0:
+              offset -= 1
+              continue
+            entries.append(entry)
+            if len(entries) >= batch_size:
+              break
+
+        if not with_metadata:
+          # headers only, the labman rows are not needed
+          for entry in entries:
+            yield self.generate_json(entry['oai_id'], entry['deleted'],
+              entry['modified'], {}, [entry['set_spec']])
+          return
+
+        # the full rows, with the text columns, of the page only; the
+        # publications and theses are loaded side by side
+        def load(record_type, get_related):
+          def run():
+            page = self.get_page_records([entry for entry in entries
+              if entry['record_type'] == record_type])
+            return page, get_related(page.values())
+          return run
+        loads = []
+        for record_type, get_related in [
+            (u'publication', self.get_publications_related),
+            (u'thesis', self.get_theses_related)]:
+          if [entry for entry in entries
+              if entry['record_type'] == record_type]:
+            loads.append(load(record_type, get_related))
+        page = {}
+        related = {}
+        for type_page, type_related in self.run_concurrently(loads):
+          page.update(type_page)
+          related.update(type_related)
+        for entry in entries:
+          yield self.get_indexed_record(entry,
+            page.get((entry['record_type'], entry['record_id'])), related)
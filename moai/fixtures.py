@@ -0,0 +1,55 @@
+"""Sample labman rows for the tests and the benchmark."""
+import datetime
+
+
+def fill_labman_database(db):
+    # two publications and a thesis, with admin log entries that
+    # touch the records themselves and the persons that wrote them
+    tables = db._db.tables
+    tables['utils_language'].insert().execute(
+        id=1, name=u'English', slug=u'english', language_tag=u'en')
+    tables['persons_person'].insert().execute(
+        [{'id': 1, 'full_name': u'Spam Author'},
+         {'id': 2, 'full_name': u'Ham Author'}])
+    tables['utils_tag'].insert().execute(id=1, name=u'spam', slug=u'spam')
+    tables['publications_publication'].insert().execute(
+        [{'id': 1, 'title': u'Spam Proceedings', 'slug': u'spam-proceedings',
+          'abstract': None, 'language_id': 1, 'published': datetime.date(2010, 5, 1),
+          'year': 2010, 'child_type': u'Proceedings'},
+         {'id': 2, 'title': u'Ham Paper', 'slug': u'ham-paper',
+          'abstract': u'About ham', 'language_id': None,
+          'published': datetime.date(2011, 1, 1),
+          'year': 2011, 'child_type': u'ConferencePaper'}])
+    tables['publications_proceedings'].insert().execute(
+        publication_ptr_id=1, publisher=u'Spam Press')
+    tables['publications_conferencepaper'].insert().execute(
+        publication_ptr_id=2, parent_proceedings_id=1)
+    tables['publications_publicationauthor'].insert().execute(
+        [{'id': 1, 'author_id': 2, 'publication_id': 2, 'position': 1},
+         {'id': 2, 'author_id': 1, 'publication_id': 2, 'position': 0}])
+    tables['publications_publicationtag'].insert().execute(
+        id=1, tag_id=1, publication_id=2)
+    tables['publications_thesis'].insert().execute(
+        id=1, title=u'Eggs Thesis', slug=u'eggs-thesis', author_id=1,
+        advisor_id=2, year=2012, main_language_id=1,
+        registration_date=datetime.date(2012, 1, 1),
+        viva_date=datetime.datetime(2012, 6, 1), viva_outcome=u'Cum laude')
+    tables['publications_thesisabstract'].insert().execute(
+        id=1, thesis_id=1, language_id=1, abstract=u'About eggs')
+    tables['django_content_type'].insert().execute(
+        [{'id': 1, 'name': u'publication', 'app_label': u'publications',
+          'model': u'publication'},
+         {'id': 2, 'name': u'person', 'app_label': u'persons',
+          'model': u'person'},
+         {'id': 3, 'name': u'thesis', 'app_label': u'publications',
+          'model': u'thesis'}])
+    add_admin_log(db, 1, 1, datetime.datetime(2012, 3, 1))
+    add_admin_log(db, 2, 2, datetime.datetime(2013, 1, 1))
+    add_admin_log(db, 3, 1, datetime.datetime(2012, 6, 1))
+
+
+def add_admin_log(db, content_type_id, object_id, action_time):
+    db._db.tables['django_admin_log'].insert().execute(
+        action_time=action_time, user_id=1, content_type_id=content_type_id,
+        object_id=object_id, object_repr=u'', action_flag=u'2',
+        change_message=u'')
@@ -0,0 +1,50 @@
+import datetime
+
+import sqlalchemy as sql
+
+ONE_DAY = datetime.timedelta(days=1)
+
+
+def day_of(bind, column):
+    """SQL expression for the day of a datetime column"""
+    if bind.dialect.name == 'sqlite':
+        return sql.func.date(column, type_=sql.Date)
+    return sql.cast(column, sql.Date)
+
+def count_window(from_date, until_date, count_days, count_range):
+    """Count the records with a datestamp between from_date (None for no
+    lower bound) and until_date, both inclusive, with a per-day
+    histogram.
+
+    count_days(first_day, last_day) sums the histogram over a range of
+    days (first_day can be None), count_range(start, end) counts the
+    records with start <= datestamp < end exactly. The histogram is
+    consulted first, so windows without records are answered without
+    looking at the records. Only the partially covered days at the
+    edges of the window are counted exactly.
+    """
+    first_day = None
+    if from_date is not None:
+        first_day = from_date.date()
+    if count_days(first_day, until_date.date()) == 0:
+        return 0
+
+    # days completely inside the window
+    first_full = first_day
+    if from_date is not None and from_date != datetime.datetime.combine(
+        first_day, datetime.time()):
+        first_full = first_day + ONE_DAY
+    end = until_date + datetime.timedelta(microseconds=1)
+    last_full = end.date() - ONE_DAY
+    if first_full is not None and first_full > last_full:
+        return count_range(from_date, end)
+
+    count = count_days(first_full, last_full)
+    if from_date is not None and first_full != first_day:
+        count += count_range(from_date,
+                             datetime.datetime.combine(first_full,
+                                                       datetime.time()))
+    last_end = datetime.datetime.combine(last_full + ONE_DAY, datetime.time())
+    if last_end < end:
+        count += count_range(last_end, end)
+    return count
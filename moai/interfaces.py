@@ -169,7 +169,8 @@ class IReadOnlyDatabase(Interface):
                   filter_sets=[],
                   from_date=None,
                   until_date=None,
-                  identifier=None):
+                  identifier=None,
+                  with_metadata=True):
         """Used by queries from the OAI server. Format returned should be the
         following:
 
@@ -177,6 +178,9 @@ class IReadOnlyDatabase(Interface):
           'metadata': <dict similar to get_metadata() output>,
           'assets': <dict similar to get_assets() output>}
         ]
+
+        When with_metadata is False only the headers are used, and the
+        metadata can be left empty.
         """
 
         
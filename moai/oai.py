@@ -25,6 +25,8 @@ class OAIServer(object):
     def __init__(self, db, config):
         self.db = db
         self.config = config
+        self._listed = []
+        self._listSize = None
 
     def identify(self):
         result = oaipmh.common.Identify(
@@ -75,22 +77,44 @@ class OAIServer(object):
             yield [set['id'], set['name'], set['description']]
 
     def listRecords(self, metadataPrefix, set=None, from_=None, until=None,
-                    cursor=0, batch_size=10):
+                    cursor=0, batch_size=10, seek=None):
         
         self._checkMetadataPrefix(metadataPrefix)
-        for record in self._listQuery(set, from_, until, cursor, batch_size):
+        for record in self._listQuery(set, from_, until, cursor, batch_size,
+                                      seek=seek):
+            self._listed.append(record)
             header, metadata = self._createHeaderAndMetadata(record)
             yield header, metadata, None
 
     def listIdentifiers(self, metadataPrefix, set=None, from_=None, until=None,
-                        cursor=0, batch_size=10):
+                        cursor=0, batch_size=10, seek=None):
         
         self._checkMetadataPrefix(metadataPrefix)
-        for record in self._listQuery(set, from_, until, cursor, batch_size):
+        for record in self._listQuery(set, from_, until, cursor, batch_size,
+                                      seek=seek, with_metadata=False):
+            self._listed.append(record)
             yield self._createHeader(record)
 
+    def getSeekKey(self, position):
+        """Return the seek key of a record from the last listing, or None
+        if the database can not seek to it"""
+        if not hasattr(self.db, 'oai_seek_key'):
+            return None
+        if position >= len(self._listed):
+            return None
+        return self.db.oai_seek_key(self._listed[position])
+
+    def getCompleteListSize(self):
+        """Return the number of records of the last listing in all its
+        batches, or None if the database can not count them"""
+        return self._listSize
+
     def getRecord(self, metadataPrefix, identifier):
         self._checkMetadataPrefix(metadataPrefix)
+        if (hasattr(self.db, 'oai_may_exist') and
+            not self.db.oai_may_exist(identifier)):
+            # unknown identifiers are answered without querying the records
+            raise oaipmh.error.IdDoesNotExistError(identifier)
         header = None
         metadata = None
         for record in self._listQuery(identifier=identifier):
@@ -121,8 +145,11 @@ class OAIServer(object):
         return header, metadata
     
     def _listQuery(self, set=None, from_=None, until=None, 
-                   cursor=0, batch_size=10, identifier=None):
+                   cursor=0, batch_size=10, identifier=None, seek=None,
+                   with_metadata=True):
             
+        self._listed = []
+        self._listSize = None
         now = datetime.utcnow()
         if until != None and until > now:
             # until should never be in the future
@@ -141,6 +168,25 @@ class OAIServer(object):
             needed_sets.add(set)
         allowed_sets = self.config.sets_allowed.copy()
         disallowed_sets = self.config.sets_disallowed.copy()    
+
+        if identifier is None and hasattr(self.db, 'oai_count'):
+            self._listSize = self.db.oai_count(
+                needed_sets=needed_sets,
+                disallowed_sets=disallowed_sets,
+                allowed_sets=allowed_sets,
+                from_date=from_,
+                until_date=until)
+            if self._listSize == 0:
+                # nothing in this window, no need to query the records
+                return []
+
+        kwargs = {}
+        if seek is not None:
+            # only passed on when a token from SeekingResumption is used
+            kwargs['seek'] = seek
+        if not with_metadata:
+            # headers only, the database can skip loading the metadata
+            kwargs['with_metadata'] = False
         
         return self.db.oai_query(offset=cursor,
                                  batch_size=batch_size,
@@ -149,9 +195,68 @@ class OAIServer(object):
                                  allowed_sets=allowed_sets,
                                  from_date=from_,
                                  until_date=until,
-                                 identifier=identifier
+                                 identifier=identifier,
+                                 **kwargs
                                  )
 
+class SeekingResumption(oaipmh.server.BatchingResumption):
+    """Batching resumption that also stores the seek key of the last
+    record of a batch in the resumption token.
+
+    Databases that support it continue the listing after that record
+    instead of skipping cursor records, so deep batches are as cheap
+    as the first one and do not shift when records change in between.
+    """
+
+    def handleVerb(self, verb, kw):
+        self.listSize = None
+        self.cursor = 0
+        if 'resumptionToken' in kw:
+            self.cursor = oaipmh.server.decodeResumptionToken(
+                kw['resumptionToken'])[1]
+        result = oaipmh.server.BatchingResumption.handleVerb(self, verb, kw)
+        if verb not in ['ListIdentifiers', 'ListRecords']:
+            return result
+        self.listSize = self._server.getCompleteListSize()
+        records, token = result
+        if token is None:
+            return result
+        seek = self._server.getSeekKey(self._batch_size - 1)
+        if seek is not None:
+            token_kw, cursor = oaipmh.server.decodeResumptionToken(token)
+            token_kw['seek'] = seek
+            token = oaipmh.server.encodeResumptionToken(token_kw, cursor)
+        return records, token
+
+class CountingTreeServer(oaipmh.server.XMLTreeServer):
+    """XML tree server that adds the completeListSize and cursor
+    attributes to resumption tokens, when the SeekingResumption knows
+    the size of the list"""
+
+    def _outputResuming(self, element, input_func, output_func, kw):
+        oaipmh.server.XMLTreeServer._outputResuming(
+            self, element, input_func, output_func, kw)
+        e_resumptionToken = element.find(
+            oaipmh.server.nsoai('resumptionToken'))
+        list_size = getattr(self._server, 'listSize', None)
+        if e_resumptionToken is not None and list_size is not None:
+            e_resumptionToken.set('completeListSize', str(list_size))
+            e_resumptionToken.set('cursor', str(self._server.cursor))
+
+class SeekingServer(oaipmh.server.ServerBase):
+    """An oaipmh server that uses SeekingResumption"""
+    
+    def __init__(self, server, metadata_registry=None, nsmap=None,
+                 resumption_batch_size=10):
+        resumption = SeekingResumption(server, resumption_batch_size)
+        oaipmh.server.ServerBase.__init__(
+            self,
+            resumption,
+            metadata_registry,
+            nsmap)
+        self._tree_server = CountingTreeServer(
+            resumption, metadata_registry, nsmap)
+
 def OAIServerFactory(db, config):
     """Create a new OAI batching OAI Server given a config and
     a database"""
@@ -161,7 +266,7 @@ def OAIServerFactory(db, config):
         metadata_registry.registerWriter(prefix,
                                          get_writer(prefix, config, db))
             
-    return oaipmh.server.BatchingServer(
+    return SeekingServer(
         OAIServer(db, config),
         metadata_registry=metadata_registry,
         resumption_batch_size=config.batch_size
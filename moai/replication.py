@@ -0,0 +1,132 @@
+import time
+import threading
+
+import sqlalchemy as sql
+
+
+class Replica(object):
+    # a read replica and the outcome of its last health check
+    def __init__(self, uri, engine):
+        self.uri = uri
+        self.engine = engine
+        self.healthy = False
+        self.lag = None
+        self.checked = None
+        self.reads = 0
+        # held while the replica is checked
+        self.lock = threading.Lock()
+
+
+class ReplicaRouter(object):
+    """Spread reads round-robin over a list of replica databases.
+
+    Every replica is checked at most once per check_interval seconds: it
+    has to answer a query, and its replication position may not be more
+    than max_lag seconds behind the one of the primary. position is a
+    function that returns the datetime of the newest change it can see
+    through the given connectable. When no replica is usable, reads go
+    to the primary.
+    """
+
+    def __init__(self, primary, uris, position,
+                 max_lag=60, check_interval=30, engine_options=None):
+        self.primary = primary
+        self.replicas = [Replica(uri, sql.create_engine(uri,
+                                                        **(engine_options or {})))
+                         for uri in uris]
+        self.max_lag = max_lag
+        self.check_interval = check_interval
+        self.primary_reads = 0
+        self._position = position
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def check(self, replica):
+        """Check that replica answers and how far it lags behind the
+        primary. When another thread is checking the replica already, its
+        last known health is returned instead of waiting for the check."""
+        if not replica.lock.acquire(False):
+            return replica.healthy
+        try:
+            replica.checked = time.time()
+            try:
+                replica_position = self._position(replica.engine)
+                primary_position = self._position(self.primary)
+            except sql.exc.SQLAlchemyError:
+                replica.healthy = False
+                replica.lag = None
+                return False
+            if primary_position is None:
+                lag = 0
+            elif replica_position is None:
+                lag = None
+            else:
+                delta = primary_position - replica_position
+                lag = max(0, delta.days * 86400 + delta.seconds +
+                          delta.microseconds / 1000000.0)
+            replica.lag = lag
+            replica.healthy = lag is not None and lag <= self.max_lag
+            return replica.healthy
+        finally:
+            replica.lock.release()
+
+    def choose(self):
+        """Return the engine of the next usable replica, or the primary
+        engine."""
+        self._lock.acquire()
+        try:
+            start = self._next
+            self._next = (self._next + 1) % max(1, len(self.replicas))
+        finally:
+            self._lock.release()
+        now = time.time()
+        for index in range(len(self.replicas)):
+            replica = self.replicas[(start + index) % len(self.replicas)]
+            if (replica.checked is None or
+                now - replica.checked >= self.check_interval):
+                self.check(replica)
+            if replica.healthy:
+                replica.reads += 1
+                return replica.engine
+        self.primary_reads += 1
+        return self.primary
+
+    def connect(self):
+        """Return a connection to the next usable replica, or to the
+        primary. A replica that can not be connected to is marked
+        unhealthy until its next check and the next one is tried."""
+        tried = set()
+        while True:
+            engine = self.choose()
+            if engine is self.primary or engine in tried:
+                return self.primary.connect()
+            tried.add(engine)
+            try:
+                return engine.connect()
+            except sql.exc.SQLAlchemyError:
+                for replica in self.replicas:
+                    if replica.engine is engine:
+                        replica.healthy = False
+                        replica.checked = time.time()
+
+    def stats(self):
+        return {'primary_reads': self.primary_reads,
+                'replicas': [{'uri': replica.uri,
+                              'healthy': replica.healthy,
+                              'lag': replica.lag,
+                              'reads': replica.reads}
+                             for replica in self.replicas]}
+
+
+def get_replica_router(primary, config, position, engine_options=None):
+    """Create a ReplicaRouter from the replicas, replica_max_lag and
+    replica_check_interval settings of an app section, or return None
+    when no replicas are configured."""
+    uris = (config.get('replicas') or '').split()
+    if not uris:
+        return None
+    return ReplicaRouter(primary, uris, position,
+                         max_lag=int(config.get('replica_max_lag', 60)),
+                         check_interval=int(config.get(
+                             'replica_check_interval', 30)),
+                         engine_options=engine_options)
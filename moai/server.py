@@ -115,7 +115,16 @@ class Server(object):
                                        'You are not allowed to download this asset')
 
         oai_server = OAIServerFactory(self._db, self._config)
-        return req.write(oai_server.handleRequest(req.query_dict()), 'text/xml')
+        if not hasattr(self._db, 'open_connection'):
+            return req.write(oai_server.handleRequest(req.query_dict()),
+                             'text/xml')
+        # let all queries of this request share one pooled connection
+        self._db.open_connection()
+        try:
+            return req.write(oai_server.handleRequest(req.query_dict()),
+                             'text/xml')
+        finally:
+            self._db.close_connection()
 
 class FeedConfig(object):
     """The feedconfig object contains all the settings for a specific
@@ -1,20 +1,32 @@
 # coding=utf8
 import os
+import shutil
+import tempfile
+import threading
 from unittest import TestCase, TestSuite, makeSuite
 import doctest
 import datetime
 import urllib2
+import base64
+import cPickle
+import zlib
 
 from lxml import etree
+import sqlalchemy as sql
+from sqlalchemy.dialects import postgresql
 import wsgi_intercept
 from wsgi_intercept.urllib2_intercept import install_opener
 
-from moai.utils import XPath
-from moai.database import Database
+from moai.utils import XPath, LRUCache
+from moai.codec import encode_metadata, decode_metadata
+from moai.bulk import BulkWriter, SQLiteBulkWriter, get_bulk_writer
+from moai.customdb import SQLDatabase as Database
+from moai.database import SQLDatabase as LabmanDatabase
 from moai.server import Server, FeedConfig
 from moai.wsgi import MOAIWSGIApp
 from moai.provider.file import FileBasedContentProvider
 from moai.example import ExampleContent
+from moai.fixtures import fill_labman_database, add_admin_log
 install_opener()
 
 FLAGS = doctest.NORMALIZE_WHITESPACE + doctest.ELLIPSIS
@@ -190,6 +202,8 @@ class DatabaseTest(TestCase):
         self.assertEquals(self.db.get_setrefs(u'oai:spam',
                                               include_hidden_sets=True),
                           [u'hamset', u'spamset'])
+        self.assertEquals([r['sets'] for r in self.db.oai_query()],
+                          [[u'spamset']])
         # hidden sets are also never shown in the oai sets listing
         self.assertEquals(list(self.db.oai_sets()),
                           [{'description': u'spam spam spam',
@@ -261,6 +275,51 @@ class DatabaseTest(TestCase):
             )],
             [u'oai:spam', u'oai:ham'])
 
+    def test_oai_count(self):
+        self.db.update_record(u'oai:spam',
+                              datetime.datetime(2010, 01, 01, 12, 00, 00),
+                              False, {u'spamset':{u'name':u'spam'},
+                                      u'hamset':{u'name':u'ham'}},
+                              {})
+        self.db.update_record(u'oai:ham',
+                              datetime.datetime(2009, 01, 01, 00, 00, 00),
+                              False, {u'hamset':{u'name':u'ham'}},
+                              {})
+        self.db.update_record(u'oai:eggs',
+                              datetime.datetime(2010, 01, 01, 18, 00, 00),
+                              False, {}, {})
+        self.db.flush()
+        windows = [(None, None),
+                   (datetime.datetime(2010, 1, 1), None),
+                   (datetime.datetime(2010, 1, 1, 12), None),
+                   (datetime.datetime(2010, 1, 1, 12, 0, 1), None),
+                   (None, datetime.datetime(2010, 1, 1, 12)),
+                   (datetime.datetime(2009, 1, 1),
+                    datetime.datetime(2010, 1, 1, 23, 59, 59)),
+                   (datetime.datetime(2011, 1, 1), None)]
+        for sets in [[], [u'hamset'], [u'spamset']]:
+            for from_date, until_date in windows:
+                self.assertEquals(
+                    self.db.oai_count(needed_sets=sets,
+                                      from_date=from_date,
+                                      until_date=until_date),
+                    len(list(self.db.oai_query(needed_sets=sets,
+                                               from_date=from_date,
+                                               until_date=until_date))))
+        # combinations of sets are only counted when they are empty
+        self.assertEquals(self.db.oai_count(
+            needed_sets=[u'spamset', u'hamset']), None)
+        self.assertEquals(self.db.oai_count(
+            needed_sets=[u'spamset', u'hamset'],
+            until_date=datetime.datetime(2009, 12, 1)), 0)
+        self.assertEquals(self.db.oai_count(
+            allowed_sets=[u'spamset', u'hamset'],
+            from_date=datetime.datetime(2011, 1, 1)), 0)
+        # the empty window is told without looking at the records
+        self.db._records.drop()
+        self.assertEquals(self.db.oai_count(
+            from_date=datetime.datetime(2011, 1, 1)), 0)
+
     def test_oai_query_identifier(self):
         self.db.update_record(u'oai:spam',
                               datetime.datetime(2010, 01, 01, 00, 00, 00),
@@ -271,6 +330,294 @@ class DatabaseTest(TestCase):
             [r['id'] for r in self.db.oai_query(identifier=u'oai:spam')],
             [u'oai:spam'])
         
+    def test_oai_query_statements(self):
+        for i in range(5):
+            self.db.update_record(u'oai:%s' % i,
+                                  datetime.datetime(2010, 1, i + 1),
+                                  False, {u'spamset': {u'name': u'spam'},
+                                          u'hamset': {u'name': u'ham'}},
+                                  {})
+        self.db.flush()
+        statements = []
+        sql.event.listen(self.db._db.bind, 'before_cursor_execute',
+                         lambda *args: statements.append(args[2]))
+        # the sets of a page are loaded at once
+        for batch_size in [1, 5]:
+            del statements[:]
+            records = list(self.db.oai_query(batch_size=batch_size))
+            self.assertEquals(len(records), batch_size)
+            self.assertEquals(records[0]['sets'], [u'hamset', u'spamset'])
+            self.assertEquals(len(statements), 4)
+        # refs to sets that are missing or have no hidden flag are left
+        # out, as GetRecord does
+        self.db._setrefs.insert().execute(record_id=u'oai:0',
+                                          set_id=u'eggset')
+        self.db._sets.insert().execute(set_id=u'baconset', name=u'bacon',
+                                       hidden=None)
+        self.db._setrefs.insert().execute(record_id=u'oai:0',
+                                          set_id=u'baconset')
+        records = list(self.db.oai_query(identifier=u'oai:0'))
+        self.assertEquals(records[0]['sets'], [u'hamset', u'spamset'])
+        self.assertEquals(records[0]['sets'],
+                          self.db.get_record(u'oai:0')['sets'])
+
+    def test_flush(self):
+        def counts():
+            return sorted(tuple(row) for row in
+                          self.db._dayCounts.select().execute())
+        self.db.update_record(u'oai:spam',
+                              datetime.datetime(2010, 01, 01, 00, 00, 00),
+                              False, {u'spamset':{u'name':u'spam'}},
+                              {'title': [u'Spam!']})
+        self.db.update_record(u'oai:ham',
+                              datetime.datetime(2010, 01, 01, 12, 00, 00),
+                              False, {u'hamset':{u'name':u'ham'}}, {})
+        self.db.flush()
+        statements = []
+        sql.event.listen(self.db._db.bind, 'before_cursor_execute',
+                         lambda conn, cursor, statement, *args:
+                         statements.append(statement))
+        # replacing a record moves it to its new sets and day
+        self.db.update_record(u'oai:spam',
+                              datetime.datetime(2011, 01, 01, 00, 00, 00),
+                              True, {u'hamset':{u'name':u'Ham'}},
+                              {'title': [u'Spam?']})
+        self.db.flush()
+        # nothing is read that does not belong to the batch
+        self.assertFalse([s for s in statements
+                          if s.startswith('SELECT') and 'WHERE' not in s])
+        self.assertEquals(self.db.get_record(u'oai:spam'),
+                          {'id': u'oai:spam', 'deleted': True,
+                           'modified': datetime.datetime(2011, 1, 1),
+                           'metadata': {'title': [u'Spam?']},
+                           'sets': [u'hamset']})
+        self.assertEquals(self.db.get_set(u'hamset')['name'], u'Ham')
+        self.assertEquals(self.db.record_count(), 2)
+        self.db.remove_record(u'oai:ham')
+        # the day counts are kept up to date with the batches
+        kept = counts()
+        self.db.update_day_counts()
+        self.assertEquals(kept, counts())
+        self.assertEquals(kept, [(u'', datetime.date(2011, 1, 1), 1),
+                                 (u'hamset', datetime.date(2011, 1, 1), 1)])
+
+    def test_bulk_writers(self):
+        connection = self.db._db.bind.connect()
+        counts = self.db._dayCounts
+        for writer in [BulkWriter(connection.dialect),
+                       get_bulk_writer(connection)]:
+            counts.delete().execute()
+            writer.upsert(connection, counts,
+                          [{'set_id': u'', 'day': datetime.date(2010, 1, 1),
+                            'records': 1},
+                           {'set_id': u'spam',
+                            'day': datetime.date(2010, 1, 1), 'records': 2}])
+            writer.upsert(connection, counts,
+                          [{'set_id': u'spam',
+                            'day': datetime.date(2010, 1, 1), 'records': 3}])
+            self.assertEquals(
+                sorted(tuple(row) for row in counts.select().execute()),
+                [(u'', datetime.date(2010, 1, 1), 1),
+                 (u'spam', datetime.date(2010, 1, 1), 3)])
+        self.assertTrue(isinstance(get_bulk_writer(connection),
+                                   SQLiteBulkWriter))
+        connection.close()
+
+    def test_oai_query_columns(self):
+        self.db.update_record(u'oai:spam',
+                              datetime.datetime(2010, 01, 01, 00, 00, 00),
+                              False, {u'spamset':{u'name':u'spam'},
+                                      u'hamset':{u'name':u'ham'}},
+                              {'title': [u'Spam!']})
+        self.db.flush()
+        statements = []
+        sql.event.listen(self.db._db.bind, 'before_cursor_execute',
+                         lambda conn, cursor, statement, *args:
+                         statements.append(statement))
+        # a record in several allowed sets is listed once, without DISTINCT
+        records = list(self.db.oai_query(
+            allowed_sets=[u'spamset', u'hamset']))
+        self.assertEquals([r['metadata'] for r in records],
+                          [{'title': [u'Spam!']}])
+        self.assertFalse([s for s in statements if 'DISTINCT' in s])
+        # headers are listed without reading the metadata column
+        del statements[:]
+        records = list(self.db.oai_query(with_metadata=False))
+        self.assertEquals([(r['id'], r['metadata']) for r in records],
+                          [(u'oai:spam', {})])
+        self.assertFalse([s for s in statements if 'metadata' in s])
+
+    def test_metadata_codecs(self):
+        metadata = {'title': [u'Spam!' * 100],
+                    'date': [datetime.datetime(2010, 01, 01, 12, 30)]}
+        decoded = {'title': [u'Spam!' * 100], 'date': [u'2010-01-01T12:30:00']}
+        stored = {}
+        for codec in ['json', 'zlib', 'pickle']:
+            self.db._codec = Database(None, {'metadata_codec': codec})._codec
+            self.db.update_record(u'oai:%s' % codec,
+                                  datetime.datetime(2010, 01, 01, 00, 00, 00),
+                                  False, {}, metadata)
+            self.db.flush()
+            stored[codec] = self.db._records.select(
+                self.db._records.c.record_id == u'oai:%s' % codec
+                ).execute().fetchone().metadata
+        # rows name their codec, plain JSON rows stay as they were
+        self.assertTrue(stored['json'].startswith('{'))
+        self.assertTrue(stored['zlib'].startswith('zlib:'))
+        self.assertTrue(stored['pickle'].startswith('pickle:'))
+        self.assertTrue(len(stored['zlib']) < len(stored['json']))
+        self.assertTrue(len(stored['pickle']) < len(stored['json']))
+        # metadata that does not compress is stored as JSON
+        self.assertEquals(encode_metadata({'title': [u'Spam!']}, 'zlib'),
+                          encode_metadata({'title': [u'Spam!']}, 'json'))
+        # every row is readable, whatever the configured codec
+        records = list(self.db.oai_query())
+        self.assertEquals([r['metadata'] for r in records], [decoded] * 3)
+        # the keys are unicode, whatever the codec
+        self.assertEquals(set([type(key) for r in records
+                               for key in r['metadata']]), set([unicode]))
+        self.assertEquals(self.db.get_record(u'oai:zlib')['metadata'],
+                          decoded)
+        # metadata is only decoded when it is used
+        record = self.db.get_record(u'oai:pickle')
+        self.assertEquals(record['metadata']._metadata, None)
+        self.assertEquals(record['metadata'].get('title'), decoded['title'])
+        self.assertEquals(record['metadata']._metadata, decoded)
+        self.assertRaises(ValueError, Database, None,
+                          {'metadata_codec': 'spam'})
+        # pickled data can not refer to globals
+        self.assertRaises(cPickle.UnpicklingError, decode_metadata,
+            'pickle:' + base64.b64encode(zlib.compress(
+                cPickle.dumps(datetime.date.today(), 2))))
+
+    def test_set_filters(self):
+        for oai_id, sets in [(u'oai:spam', [u'spamset', u'hamset']),
+                             (u'oai:ham', [u'hamset']),
+                             (u'oai:eggs', [u'eggset']),
+                             (u'oai:bacon', [])]:
+            self.db.update_record(oai_id,
+                                  datetime.datetime(2010, 01, 01, 00, 00, 00),
+                                  False,
+                                  dict([(set_id, {u'name': set_id})
+                                        for set_id in sets]),
+                                  {})
+        self.db.flush()
+        for kwargs, ids in [
+            ({'needed_sets': [u'spamset', u'hamset']}, [u'oai:spam']),
+            ({'allowed_sets': [u'spamset', u'eggset']},
+             [u'oai:eggs', u'oai:spam']),
+            ({'disallowed_sets': [u'hamset']}, [u'oai:bacon', u'oai:eggs']),
+            ({'needed_sets': [u'hamset'], 'disallowed_sets': [u'spamset']},
+             [u'oai:ham']),
+            ({'allowed_sets': [u'hamset', u'eggset'],
+              'disallowed_sets': [u'spamset']}, [u'oai:eggs', u'oai:ham']),
+            ({'needed_sets': [u'hamset'], 'allowed_sets': [u'spamset']},
+             [u'oai:spam'])]:
+            self.assertEquals(
+                sorted(r['id'] for r in self.db.oai_query(**kwargs)), ids)
+
+        # the sets are checked by one subquery, the plan does not grow
+        # with the number of sets
+        many = [u'set%s' % i for i in range(20)]
+        for kwargs in [{'needed_sets': many}, {'allowed_sets': many},
+                       {'disallowed_sets': many},
+                       {'needed_sets': many[:10], 'allowed_sets': many[10:15],
+                        'disallowed_sets': many[15:]}]:
+            one = dict([(key, value[:1]) for key, value in kwargs.items()])
+            plan = self.db.explain(self.db.get_records_query(**kwargs))
+            self.assertEquals(plan,
+                              self.db.explain(self.db.get_records_query(**one)))
+            self.assertTrue([line for line in plan
+                             if 'INDEX ix_setrefs_set_id' in line])
+            query = unicode(self.db.get_records_query(**kwargs).compile(
+                dialect=postgresql.dialect()))
+            self.assertEquals(query.count('SELECT'), 2)
+            self.assertFalse('EXISTS' in query)
+
+    def test_partitions(self):
+        self.assertRaises(ValueError, Database, None, {'partition_by': 'day'})
+        path = tempfile.mkdtemp()
+        try:
+            uri = 'sqlite:///%s' % os.path.join(path, 'moai.db')
+            db = Database(uri, {'partition_by': 'month',
+                                'query_threads': '2'})
+            for database in [self.db, db]:
+                for day in range(1, 91, 3):
+                    modified = (datetime.datetime(2010, 01, 01) +
+                                datetime.timedelta(days=day))
+                    database.update_record(
+                        u'oai:%s' % day, modified, False,
+                        {[u'spamset', u'hamset'][day % 2]: {u'name': u'set'}},
+                        {'day': [day]})
+                database.flush()
+                # moving a record to another month moves its partition
+                database.update_record(u'oai:1',
+                                       datetime.datetime(2010, 03, 31),
+                                       False, {}, {'day': [1]})
+                database.flush()
+                database.remove_record(u'oai:4')
+            self.assertEquals(
+                sorted([row[0] for row in db.execute(sql.select(
+                    [db._partitions.c.partition_key]))]),
+                [u'201001', u'201002', u'201003'])
+            # the records table only keeps the headers
+            self.assertEquals(
+                set([row[0] for row in db.execute(sql.select(
+                    [db._records.c.metadata]))]), set([None]))
+            self.assertEquals(db.get_record(u'oai:1')['metadata'],
+                              {'day': [1]})
+
+            threads = set()
+            statements = []
+            def listen(conn, cursor, statement, *args):
+                threads.add(threading.current_thread().name)
+                statements.append(statement)
+            sql.event.listen(db._db.bind, 'before_cursor_execute', listen)
+            for kwargs in [{}, {'offset': 5, 'batch_size': 10},
+                           {'offset': 10, 'batch_size': 100},
+                           {'allowed_sets': [u'spamset']},
+                           {'from_date': datetime.datetime(2010, 02, 10)},
+                           {'until_date': datetime.datetime(2010, 02, 10),
+                            'batch_size': 100},
+                           {'identifier': u'oai:1'}]:
+                self.assertEquals(list(db.oai_query(**kwargs)),
+                                  list(self.db.oai_query(**kwargs)))
+            # the partitions were queried side by side
+            self.assertTrue(len(threads - set(['MainThread'])) > 0)
+            # partitions outside the window are not queried
+            del statements[:]
+            list(db.oai_query(from_date=datetime.datetime(2010, 02, 10)))
+            self.assertFalse([s for s in statements if 'records_201001' in s])
+        finally:
+            shutil.rmtree(path)
+
+    def test_identifier_filter(self):
+        self.assertEquals(self.db.oai_may_exist(u'oai:spam'), False)
+        self.db.update_record(u'oai:spam',
+                              datetime.datetime(2010, 01, 01, 00, 00, 00),
+                              False, {u'spamset':{u'name':u'spam'}},
+                              {})
+        self.db.flush()
+        self.assertEquals(self.db.oai_may_exist(u'oai:spam'), True)
+        self.assertEquals(self.db.oai_may_exist(u'oai:ham'), False)
+        # unknown identifiers are answered without counting the records
+        statements = []
+        sql.event.listen(self.db._db.bind, 'before_cursor_execute',
+                         lambda conn, cursor, statement, *args:
+                         statements.append(statement))
+        self.assertEquals(self.db.oai_may_exist(u'oai:ham'), False)
+        self.assertFalse([s for s in statements if 'count' in s])
+        # records written by another process are noticed by the time of
+        # its last write
+        self.db._records.insert().execute(
+            record_id=u'oai:ham', deleted=False, metadata='{}',
+            modified=datetime.datetime(2011, 01, 01, 00, 00, 00))
+        self.db._writeMarks.update().execute(
+            written=datetime.datetime.utcnow() + datetime.timedelta(seconds=1))
+        self.assertEquals(self.db.oai_may_exist(u'oai:ham'), True)
+        self.db.remove_record(u'oai:spam')
+        self.assertEquals(self.db.oai_may_exist(u'oai:spam'), False)
+
     def test_oai_query_future_dates(self):
         # records with a timestamp in the future should never
         # be returned, this feature can be used to create embargo dates
@@ -352,6 +699,577 @@ class DatabaseTest(TestCase):
         self.assertEquals([r['id'] for r in self.db.oai_query(
             batch_size=1, offset=2)], [u'oai:spamspamspam'])
 
+class LabmanDatabaseTest(TestCase):
+    def setUp(self):
+        self.db = LabmanDatabase()
+        fill_labman_database(self.db)
+
+    def tearDown(self):
+        del self.db
+
+    def test_oai_query(self):
+        records = list(self.db.oai_query())
+        # without a from date publications and theses are listed in id order
+        self.assertEquals([r['id'] for r in records],
+                          [u'1/spam-proceedings', u'2/ham-paper',
+                           u'1/eggs-thesis'])
+        self.assertEquals([r['modified'] for r in records],
+                          [datetime.datetime(2012, 3, 1),
+                           datetime.datetime(2013, 1, 1),
+                           datetime.datetime(2012, 6, 1)])
+        self.assertEquals(records[1]['sets'], [u'ConferencePaper'])
+        # creators are ordered by author position
+        self.assertEquals(records[1]['metadata']['creator'],
+                          [u'Spam Author', u'Ham Author'])
+        self.assertEquals(records[1]['metadata']['subject'], [u'spam'])
+        self.assertEquals(records[1]['metadata']['language'], [u'en'])
+        self.assertEquals(records[0]['metadata']['language'], [u'en'])
+        # with a from date records are listed in datestamp order
+        self.assertEquals([r['id'] for r in self.db.oai_query(
+            from_date=datetime.datetime(2000, 1, 1))],
+                          [u'1/spam-proceedings', u'1/eggs-thesis',
+                           u'2/ham-paper'])
+
+    def test_oai_query_lazy(self):
+        # the thesis table is not read when the publications fill the batch
+        self.db._db.tables['publications_thesis'].drop()
+        self.assertEquals([r['id'] for r in self.db.oai_query(
+            batch_size=2)], [u'1/spam-proceedings', u'2/ham-paper'])
+        # seeking continues in id order
+        seek = self.db.oai_seek_key(list(self.db.oai_query(batch_size=1))[0])
+        self.assertEquals([r['id'] for r in self.db.oai_query(
+            offset=5, batch_size=1, seek=seek)], [u'2/ham-paper'])
+
+    def test_query_threads(self):
+        # in memory databases can not be shared between threads
+        self.assertFalse(self.db.can_query_concurrently())
+        path = tempfile.mkdtemp()
+        try:
+            uri = 'sqlite:///%s' % os.path.join(path, 'labman.db')
+            fill_labman_database(LabmanDatabase(uri))
+            serial = LabmanDatabase(uri, {'query_threads': '1'})
+            db = LabmanDatabase(uri, {'query_threads': '2'})
+            threads = set()
+            sql.event.listen(db._db.bind, 'before_cursor_execute',
+                             lambda *args: threads.add(
+                                 threading.current_thread().name))
+            for kwargs in [{}, {'offset': 1, 'batch_size': 1},
+                           {'disallowed_sets': [u'Thesis']}]:
+                from_date = datetime.datetime(2000, 1, 1)
+                db.open_connection()
+                self.assertEquals(
+                    list(db.oai_query(from_date=from_date, **kwargs)),
+                    list(serial.oai_query(from_date=from_date, **kwargs)))
+                db.close_connection()
+            # the request thread queried one type, a helper the other
+            self.assertTrue('MainThread' in threads)
+            self.assertTrue(len(threads - set(['MainThread'])) > 0)
+            # errors of the helpers reach the request thread
+            def fail():
+                raise ValueError('spam')
+            self.assertRaises(ValueError, db.run_concurrently,
+                              [lambda: 1, fail])
+            self.assertEquals(db.run_concurrently(
+                [lambda i=i: i for i in range(5)]), range(5))
+        finally:
+            shutil.rmtree(path)
+
+    def test_indexes(self):
+        self.assertEquals([name for name, table, columns
+                           in self.db.get_missing_indexes()],
+                          [name for name, table, columns
+                           in self.db.required_indexes])
+        queries = self.db.get_hot_queries()
+        self.assertFalse([description for description, statement in queries
+                          if 'USING INDEX' in ''.join(
+                              self.db.explain(statement))])
+        self.assertEquals(len(self.db.create_indexes()), 4)
+        # existing indexes are left alone
+        self.assertEquals(self.db.get_missing_indexes(), [])
+        self.assertEquals(self.db.create_indexes(), [])
+        for description, statement in queries:
+            self.assertTrue('USING INDEX moai_' in ''.join(
+                self.db.explain(statement)), description)
+        self.assertEquals(len(list(self.db.oai_query())), 3)
+
+    def test_set_filters(self):
+        filters = [({'allowed_sets': [u'Proceedings', u'Thesis']},
+                    [u'1/spam-proceedings', u'1/eggs-thesis']),
+                   ({'disallowed_sets': [u'Thesis']},
+                    [u'1/spam-proceedings', u'2/ham-paper']),
+                   ({'needed_sets': [u'Proceedings', u'ConferencePaper'],
+                     'disallowed_sets': [u'Proceedings']},
+                    [u'2/ham-paper']),
+                   ({'needed_sets': [u'Thesis'],
+                     'allowed_sets': [u'Proceedings']}, [])]
+        for index in [False, True]:
+            if index:
+                self.db.rebuild_index()
+            for from_date in [None, datetime.datetime(2000, 1, 1)]:
+                for kwargs, ids in filters:
+                    records = list(self.db.oai_query(from_date=from_date,
+                                                     **kwargs))
+                    self.assertEquals(sorted(r['id'] for r in records),
+                                      sorted(ids))
+                    if index:
+                        self.assertEquals(self.db.oai_count(
+                            from_date=from_date, **kwargs), len(ids))
+        self.assertEquals(list(self.db.oai_query(
+            identifier=u'1/eggs-thesis', disallowed_sets=[u'Thesis'])), [])
+        # the thesis table is not read when its set is excluded
+        self.db._db.tables['moai_state'].delete().execute()
+        self.db._db.tables['publications_thesis'].drop()
+        self.assertEquals([r['id'] for r in self.db.oai_query(
+            disallowed_sets=[u'Thesis'])],
+                          [u'1/spam-proceedings', u'2/ham-paper'])
+        self.assertEquals([r['id'] for r in self.db.oai_query(
+            allowed_sets=[u'ConferencePaper'])], [u'2/ham-paper'])
+
+    def test_latest_actions_refresh(self):
+        refreshes = []
+        refresh = self.db.refresh_latest_actions
+        def counting_refresh():
+            refreshes.append(True)
+            return refresh()
+        self.db.refresh_latest_actions = counting_refresh
+        ids = [r['id'] for r in self.db.oai_query()]
+        # a request refreshes the rollup once, whatever it reads
+        del refreshes[:]
+        self.db.open_connection()
+        try:
+            list(self.db.oai_query())
+            list(self.db.oai_query(from_date=datetime.datetime(2000, 1, 1)))
+            self.db.get_record(u'2/ham-paper')
+        finally:
+            self.db.close_connection()
+        self.assertEquals(len(refreshes), 1)
+        # when a concurrent writer locks the database the rollup is read
+        # as it is
+        def locked_refresh():
+            raise sql.exc.OperationalError('UPDATE moai_state', {},
+                                           Exception('database is locked'))
+        self.db.refresh_latest_actions = locked_refresh
+        self.db.open_connection()
+        try:
+            self.assertEquals([r['id'] for r in self.db.oai_query()], ids)
+        finally:
+            self.db.close_connection()
+
+    def test_year_start_datestamps(self):
+        # without admin log entries records are dated at the start of
+        # their year, these datestamps sit exactly on the boundaries
+        self.db._db.tables['django_admin_log'].delete().execute()
+        publications = self.db._db.tables['publications_publication']
+        publications.update(publications.c.id == 2).execute(year=2010)
+        from_date = datetime.datetime(2010, 1, 1)
+        first = list(self.db.oai_query(from_date=from_date))[0]
+        self.assertEquals(first['id'], u'1/spam-proceedings')
+        seek = self.db.oai_seek_key(first)
+        for built in [False, True]:
+            if built:
+                self.db.rebuild_index()
+            self.assertEquals([r['id'] for r in self.db.oai_query(
+                from_date=from_date)],
+                [u'1/spam-proceedings', u'2/ham-paper', u'1/eggs-thesis'])
+            self.assertEquals([r['id'] for r in self.db.oai_query(
+                from_date=from_date, seek=seek)],
+                [u'2/ham-paper', u'1/eggs-thesis'])
+
+    def test_oai_query_columns(self):
+        statements = []
+        sql.event.listen(self.db._db.bind, 'before_cursor_execute',
+                         lambda conn, cursor, statement, *args:
+                         statements.append(statement))
+        records = list(self.db.oai_query(batch_size=2, offset=1))
+        self.assertEquals([r['id'] for r in records],
+                          [u'2/ham-paper', u'1/eggs-thesis'])
+        # the text columns are only read for the rendered records
+        text_reads = [s for s in statements if 'bibtex' in s]
+        self.assertEquals(len(text_reads), 1)
+        self.assertTrue('IN (' in text_reads[0])
+        # and not at all when only headers are listed
+        del statements[:]
+        headers = list(self.db.oai_query(batch_size=2, offset=1,
+                                         with_metadata=False))
+        self.assertEquals(headers, [dict(r, metadata={}) for r in records])
+        self.assertFalse([s for s in statements if 'bibtex' in s])
+        self.db.rebuild_index()
+        self.assertFalse([s for s in statements if 'bibtex' in s])
+
+    def test_get_record(self):
+        records = list(self.db.oai_query())
+        self.assertEquals(self.db.get_record(u'2/ham-paper'), records[1])
+        self.assertEquals(self.db.get_record(u'1/eggs-thesis'), records[2])
+        # the slug has to match, publications and theses share ids
+        self.assertEquals(self.db.get_record(u'1/ham-paper'), None)
+        self.assertEquals(self.db.get_record(u'spam'), None)
+        self.assertEquals(list(self.db.oai_query(identifier=u'2/ham-paper',
+            needed_sets=[u'Thesis'])), [])
+        self.assertEquals(list(self.db.oai_query(identifier=u'2/ham-paper',
+            until_date=datetime.datetime(2012, 1, 1))), [])
+        # with the index the record keeps the indexed datestamp
+        self.db.rebuild_index()
+        self.assertEquals(self.db.get_record(u'2/ham-paper'), records[1])
+        publications = self.db._db.tables['publications_publication']
+        publications.delete(publications.c.id == 2).execute()
+        self.assertEquals(self.db.get_record(u'2/ham-paper')['deleted'], True)
+        self.assertEquals(self.db.get_record(u'1/ham-paper'), None)
+
+    def test_modified_dates(self):
+        publications = self.db._db.tables['publications_publication']
+        rows = publications.select().execute().fetchall()
+        self.assertEquals(self.db.get_pubmodified_dates(rows),
+                          {1: datetime.datetime(2012, 3, 1),
+                           2: datetime.datetime(2013, 1, 1)})
+        # without admin log entries the publication year is used
+        self.db._db.tables['django_admin_log'].delete().execute()
+        self.db.rebuild_latest_actions()
+        self.assertEquals(self.db.get_pubmodified_dates(rows),
+                          {1: datetime.datetime(2010, 1, 1),
+                           2: datetime.datetime(2011, 1, 1)})
+
+    def test_metadata(self):
+        self.assertEquals(self.db.normalize_text(u'spam-\nham\neggs\t\r'),
+                          u'spamham eggs')
+        publications = self.db._db.tables['publications_publication']
+        publications.update(publications.c.id == 1).execute(
+            title=u'"Spam" \\ Proceed-\nings')
+        abstracts = self.db._db.tables['publications_thesisabstract']
+        abstracts.delete().execute()
+        records = list(self.db.oai_query())
+        self.assertEquals(records[0]['metadata']['title'],
+                          [u'"Spam" \\ Proceedings'])
+        self.assertEquals(records[2]['metadata'],
+                          {'type': [u'doctoral dissertation'],
+                           'format': [u'digital'],
+                           'title': [u'Eggs Thesis'],
+                           'date': [u'2012-01-01T00:00:00Z'],
+                           'creator': [u'Spam Author'],
+                           'language': [u'en']})
+        # publications without a published date have no date
+        publications.update(publications.c.id == 1).execute(published=None)
+        records = list(self.db.oai_query())
+        self.assertEquals('date' in records[0]['metadata'], False)
+
+    def test_statement_cache(self):
+        self.assertEquals(self.db.search_language(1).language_tag, u'en')
+        self.assertEquals(self.db.search_content_type(
+            u'persons', u'person').id, 2)
+        self.assertEquals(len(self.db.search_logs(1, 1)), 1)
+        self.assertEquals(self.db.search_author(2).full_name, u'Ham Author')
+        self.assertEquals(self.db.search_author(3), None)
+        self.assertEquals(self.db.statement_cache_stats(),
+                          {'statements': 4, 'compiles': 4, 'hits': 1})
+        for from_date in [None, datetime.datetime(2000, 1, 1)]:
+            list(self.db.oai_query(from_date=from_date))
+            stats = self.db.statement_cache_stats()
+            self.assertEquals([r['id'] for r in self.db.oai_query(
+                from_date=from_date, needed_sets=[u'ConferencePaper'])],
+                              [u'2/ham-paper'])
+            self.assertEquals([r['id'] for r in self.db.oai_query(
+                from_date=from_date, needed_sets=[u'Proceedings',
+                                                  u'Thesis'])],
+                              [u'1/spam-proceedings', u'1/eggs-thesis'])
+            # repeated queries with other values reuse the statements
+            self.assertEquals(
+                self.db.statement_cache_stats()['compiles'] -
+                stats['compiles'], 1)
+
+    def test_connections(self):
+        checkouts = []
+        sql.event.listen(self.db._db.bind.pool, 'checkout',
+                         lambda *args: checkouts.append(1))
+        list(self.db.oai_query())
+        self.assertNotEquals(len(checkouts), 1)
+        # all queries of a request share one connection
+        del checkouts[:]
+        self.db.open_connection()
+        list(self.db.oai_query())
+        list(self.db.oai_query(from_date=datetime.datetime(2000, 1, 1)))
+        self.db.close_connection()
+        self.assertEquals(len(checkouts), 1)
+        self.assertEquals(self.db.pool_stats()['pool'],
+                          'SingletonThreadPool')
+
+    def test_pool_options(self):
+        db = LabmanDatabase('sqlite://', {'pool_size': '3',
+                                          'pool_recycle': '3600',
+                                          'pool_pre_ping': 'true'})
+        self.assertEquals(db._db.bind.pool.size, 3)
+        self.assertEquals(db._db.bind.pool._recycle, 3600)
+        self.assertEquals(db._db.bind.pool._pre_ping, True)
+
+    def test_oai_count(self):
+        self.assertEquals(self.db.oai_count(), None)
+        self.db.rebuild_index()
+        windows = [(None, None),
+                   (datetime.datetime(2012, 4, 1),
+                    datetime.datetime(2012, 12, 1)),
+                   (datetime.datetime(2012, 6, 1, 0, 0, 1), None),
+                   (None, datetime.datetime(2012, 6, 1)),
+                   (datetime.datetime(2014, 1, 1), None)]
+        for sets in [[], [u'Proceedings', u'Thesis']]:
+            for from_date, until_date in windows:
+                self.assertEquals(
+                    self.db.oai_count(needed_sets=sets,
+                                      from_date=from_date,
+                                      until_date=until_date),
+                    len(list(self.db.oai_query(needed_sets=sets,
+                                               from_date=from_date,
+                                               until_date=until_date))))
+        # the counts follow the index
+        add_admin_log(self.db, 1, 1, datetime.datetime(2014, 6, 1))
+        self.db.refresh_index()
+        self.assertEquals(self.db.oai_count(
+            from_date=datetime.datetime(2014, 1, 1)), 1)
+
+    def test_parents(self):
+        publications = self.db._db.tables['publications_publication']
+        rows = publications.select().execute().fetchall()
+        parents = self.db.get_parents(rows)
+        # the proceedings are the parent of themselves and of the paper
+        self.assertEquals(sorted(parents.keys()), [1, 2])
+        self.assertEquals([parents[i].parent_id for i in [1, 2]], [1, 1])
+        self.assertEquals([parents[i].publisher for i in [1, 2]],
+                          [u'Spam Press', u'Spam Press'])
+        records = list(self.db.oai_query())
+        self.assertEquals(records[1]['metadata']['publisher'],
+                          [u'Spam Press'])
+        # a paper with a missing parent has no publisher
+        proceedings = self.db._db.tables['publications_proceedings']
+        proceedings.delete().execute()
+        self.assertEquals(self.db.get_parents(rows).keys(), [2])
+        self.assertEquals(self.db.get_parents(rows)[2].parent_id, 1)
+        records = list(self.db.oai_query())
+        self.assertEquals('publisher' in records[1]['metadata'], False)
+
+    def test_reference_cache(self):
+        list(self.db.oai_query())
+        misses = self.db.reference_cache_stats()['misses']
+        records = list(self.db.oai_query())
+        stats = self.db.reference_cache_stats()
+        self.assertEquals(stats['misses'], misses)
+        self.assertEquals(stats['size'], 5)
+        self.assertEquals(records[1]['metadata']['creator'],
+                          [u'Spam Author', u'Ham Author'])
+        # changes are picked up once the admin log grows
+        persons = self.db._db.tables['persons_person']
+        persons.update(persons.c.id == 1).execute(full_name=u'Eggs Author')
+        records = list(self.db.oai_query())
+        self.assertEquals(records[2]['metadata']['creator'], [u'Spam Author'])
+        add_admin_log(self.db, 2, 1, datetime.datetime(2014, 1, 1))
+        records = list(self.db.oai_query())
+        self.assertEquals(records[2]['metadata']['creator'], [u'Eggs Author'])
+        # the cache is shared by the request and query threads
+        cache = LRUCache(size=10)
+        errors = []
+        def fill(start):
+            try:
+                for key in xrange(start, start + 2000):
+                    cache.set(key, key)
+                    cache.get(key - 5)
+            except Exception, e:
+                errors.append(e)
+        threads = [threading.Thread(target=fill, args=(i * 2000,))
+                   for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEquals(errors, [])
+        self.assertTrue(len(cache) <= 10)
+
+    def test_identifier_filter(self):
+        self.assertEquals(self.db.oai_may_exist(u'2/ham-paper'), True)
+        self.assertEquals(self.db.oai_may_exist(u'1/eggs-thesis'), True)
+        self.assertEquals(self.db.oai_may_exist(u'2/spam-paper'), False)
+        # renaming a record is picked up once the admin log grows
+        publications = self.db._db.tables['publications_publication']
+        publications.update(publications.c.id == 2).execute(
+            slug=u'spam-paper')
+        add_admin_log(self.db, 3, 2, datetime.datetime(2014, 1, 1))
+        self.assertEquals(self.db.oai_may_exist(u'2/spam-paper'), True)
+        self.assertEquals(self.db.oai_may_exist(u'2/ham-paper'), False)
+        # the index has the deleted records too
+        self.db.rebuild_index()
+        publications.delete(publications.c.id == 1).execute()
+        add_admin_log(self.db, 3, 1, datetime.datetime(2015, 1, 1))
+        self.db.refresh_index()
+        self.assertEquals(self.db.oai_may_exist(u'1/spam-proceedings'), True)
+        self.assertEquals(self.db.get_identifier_filter().stats(),
+                          {'size': 3, 'checks': 1, 'rejects': 0})
+
+    def test_latest_actions(self):
+        self.assertEquals(self.db.refresh_latest_actions(), 3)
+        self.assertEquals(self.db.refresh_latest_actions(), 0)
+        add_admin_log(self.db, 1, 1, datetime.datetime(2011, 1, 1))
+        add_admin_log(self.db, 1, 1, datetime.datetime(2014, 1, 1))
+        self.assertEquals(self.db.refresh_latest_actions(), 1)
+        # lookups go through the rollup, which is refreshed lazily
+        add_admin_log(self.db, 2, 1, datetime.datetime(2015, 1, 1))
+        self.assertEquals(self.db.get_latest_actions(
+            [('publications_publication', 1), ('persons_person', 1),
+             ('persons_person', 3)]),
+            {('publications_publication', u'1'):
+             datetime.datetime(2014, 1, 1),
+             ('persons_person', u'1'): datetime.datetime(2015, 1, 1)})
+
+    def test_index(self):
+        self.assertEquals(self.db.index_is_built(), False)
+        live = list(self.db.oai_query(
+            from_date=datetime.datetime(2000, 1, 1)))
+        self.assertEquals(self.db.rebuild_index(), 3)
+        # the index gives the same results as the live tables
+        self.assertEquals(list(self.db.oai_query()), live)
+        self.assertEquals([r['id'] for r in self.db.oai_query(
+            from_date=datetime.datetime(2012, 4, 1),
+            until_date=datetime.datetime(2012, 12, 1))],
+                          [u'1/eggs-thesis'])
+        self.assertEquals([r['id'] for r in self.db.oai_query(
+            needed_sets=[u'Proceedings'])], [u'1/spam-proceedings'])
+        self.assertEquals([r['id'] for r in self.db.oai_query(
+            offset=1, batch_size=1)], [u'1/eggs-thesis'])
+        self.assertEquals([r['id'] for r in self.db.oai_query(
+            identifier=u'2/ham-paper')], [u'2/ham-paper'])
+        self.assertEquals(list(self.db.oai_query(
+            identifier=u'2/spam-paper')), [])
+        # seeking continues after a record, independent of the offset
+        first = list(self.db.oai_query(batch_size=1))[0]
+        seek = self.db.oai_seek_key(first)
+        self.assertEquals([r['id'] for r in self.db.oai_query(
+            offset=5, seek=seek)], [u'1/eggs-thesis', u'2/ham-paper'])
+        # a record edited during a harvest moves behind the seek key
+        # instead of shifting the records that follow it
+        add_admin_log(self.db, 3, 1, datetime.datetime(2015, 1, 1))
+        self.db.refresh_index()
+        self.assertEquals([r['id'] for r in self.db.oai_query(
+            seek=seek)], [u'2/ham-paper', u'1/eggs-thesis'])
+        # nothing changed, so a refresh leaves everything alone
+        self.assertEquals(self.db.refresh_index(), 0)
+        # editing an author touches the records that author wrote
+        add_admin_log(self.db, 2, 1, datetime.datetime(2014, 1, 1))
+        self.assertEquals(self.db.refresh_index(), 2)
+        self.assertEquals([r['id'] for r in self.db.oai_query()],
+                          [u'1/spam-proceedings', u'2/ham-paper',
+                           u'1/eggs-thesis'])
+        # removed records stay in the index as deleted records
+        publications = self.db._db.tables['publications_publication']
+        publications.delete(publications.c.id == 1).execute()
+        self.assertEquals(self.db.refresh_index(), 1)
+        record = list(self.db.oai_query(
+            identifier=u'1/spam-proceedings'))[0]
+        self.assertEquals(record['deleted'], True)
+        self.assertEquals(record['metadata'], {})
+
+class ReplicationTest(TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def uri(self, name):
+        return 'sqlite:///%s' % os.path.join(self.path, name)
+
+    def copy(self, source, target):
+        shutil.copy(os.path.join(self.path, source),
+                    os.path.join(self.path, target))
+
+    def test_replicas(self):
+        db = Database(self.uri('primary.db'))
+        db.update_record(u'oai:spam', datetime.datetime(2009, 1, 1),
+                         False, {}, {})
+        db.flush()
+        self.copy('primary.db', 'stale.db')
+        # the stale replica missed the writes of the last two hours
+        stale = Database(self.uri('stale.db'))
+        stale._writeMarks.update().execute(
+            written=datetime.datetime.utcnow() - datetime.timedelta(hours=2))
+        db.update_record(u'oai:ham', datetime.datetime(2010, 1, 1),
+                         False, {}, {})
+        db.flush()
+        self.copy('primary.db', 'fresh.db')
+        db = Database(self.uri('primary.db'), {
+            'replicas': '%s %s %s' % (self.uri('stale.db'),
+                                      self.uri('fresh.db'),
+                                      self.uri('missing/broken.db')),
+            'replica_max_lag': '3600'})
+        # reads are spread over the replicas that are up to date
+        for i in range(3):
+            db.open_connection()
+            self.assertEquals(db.record_count(), 2)
+            db.close_connection()
+        self.assertEquals(
+            [(r['healthy'], r['reads'])
+             for r in db._router.stats()['replicas']],
+            [(False, 0), (True, 3), (False, 0)])
+        # writes go to the primary, the lag is measured by the time of
+        # the writes, not by the datestamps of the records
+        db.update_record(u'oai:eggs', datetime.datetime(2000, 1, 1),
+                         False, {}, {})
+        db.flush()
+        self.assertEquals(db.record_count(), 3)
+        db.open_connection()
+        self.assertEquals(db.record_count(), 2)
+        db.close_connection()
+        # until the replica lags too much
+        db._router.max_lag = 0
+        db._router.check_interval = 0
+        db.open_connection()
+        self.assertEquals(db.record_count(), 3)
+        db.close_connection()
+        self.assertEquals(db._router.stats()['primary_reads'], 1)
+
+    def test_replica_failover(self):
+        db = Database(self.uri('primary.db'))
+        db.update_record(u'oai:spam', datetime.datetime(2009, 1, 1),
+                         False, {}, {})
+        db.flush()
+        os.mkdir(os.path.join(self.path, 'replica'))
+        self.copy('primary.db', os.path.join('replica', 'replica.db'))
+        db = Database(self.uri('primary.db'), {
+            'replicas': self.uri(os.path.join('replica', 'replica.db'))})
+        db.open_connection()
+        db.close_connection()
+        self.assertEquals(db._router.stats()['replicas'][0]['healthy'], True)
+        # the replica goes away before its next check, the request
+        # falls back to the primary
+        shutil.rmtree(os.path.join(self.path, 'replica'))
+        db.open_connection()
+        self.assertEquals(db.record_count(), 1)
+        db.close_connection()
+        stats = db._router.stats()
+        self.assertEquals(stats['replicas'][0]['healthy'], False)
+        self.assertEquals(stats['primary_reads'], 1)
+        # a check that is running already is not waited for
+        replica = db._router.replicas[0]
+        replica.lock.acquire()
+        try:
+            replica.healthy = True
+            self.assertEquals(db._router.check(replica), True)
+        finally:
+            replica.lock.release()
+        self.assertEquals(db._router.check(replica), False)
+
+    def test_labman_replicas(self):
+        db = LabmanDatabase(self.uri('primary.db'))
+        fill_labman_database(db)
+        self.copy('primary.db', 'replica.db')
+        db = LabmanDatabase(self.uri('primary.db'),
+                            {'replicas': self.uri('replica.db')})
+        db.open_connection()
+        self.assertEquals(len(list(db.oai_query())), 3)
+        db.close_connection()
+        add_admin_log(db, 1, 2, datetime.datetime(2014, 1, 1))
+        db._router.check_interval = 0
+        db.open_connection()
+        self.assertEquals([r['modified'] for r in db.oai_query(
+            identifier=u'2/ham-paper')], [datetime.datetime(2014, 1, 1)])
+        db.close_connection()
+        stats = db.pool_stats()['replication']
+        self.assertEquals(stats['primary_reads'], 1)
+        self.assertEquals(stats['replicas'][0]['reads'], 1)
+
 class ProviderTest(TestCase):
     def setUp(self):
         path = os.path.abspath(os.path.dirname(__file__))
@@ -433,6 +1351,43 @@ class ServerTest(TestCase):
         self.assertEquals(xpath.strings('//oai:identifier'),
                           [u'oai:ham', u'oai:spam', u'oai:spamspamspam'])
 
+    def test_list_size(self):
+        self.config.batch_size = 2
+        xml = urllib2.urlopen('http://test?verb=ListIdentifiers'
+                              '&metadataPrefix=oai_dc').read()
+        doc = etree.fromstring(xml)
+        xpath = XPath(doc, nsmap=
+                      {"oai": "http://www.openarchives.org/OAI/2.0/"})
+        self.assertEquals(
+            xpath.string('//oai:resumptionToken/@completeListSize'), u'3')
+        self.assertEquals(xpath.string('//oai:resumptionToken/@cursor'), u'0')
+        xml = urllib2.urlopen('http://test?verb=ListIdentifiers'
+                              '&metadataPrefix=oai_dc&from=2011-01-01').read()
+        doc = etree.fromstring(xml)
+        xpath = XPath(doc, nsmap=
+                      {"oai": "http://www.openarchives.org/OAI/2.0/"})
+        self.assertEquals(xpath.string('//oai:error/@code'),
+                          u'noRecordsMatch')
+
+    def test_get_record_unknown(self):
+        xml = urllib2.urlopen('http://test?verb=GetRecord'
+                              '&metadataPrefix=oai_dc'
+                              '&identifier=oai:eggs').read()
+        doc = etree.fromstring(xml)
+        xpath = XPath(doc, nsmap=
+                      {"oai": "http://www.openarchives.org/OAI/2.0/"})
+        self.assertEquals(xpath.string('//oai:error/@code'),
+                          u'idDoesNotExist')
+        self.assertEquals(
+            self.db.get_identifier_filter().stats()['rejects'], 1)
+        xml = urllib2.urlopen('http://test?verb=GetRecord'
+                              '&metadataPrefix=oai_dc'
+                              '&identifier=oai:ham').read()
+        doc = etree.fromstring(xml)
+        xpath = XPath(doc, nsmap=
+                      {"oai": "http://www.openarchives.org/OAI/2.0/"})
+        self.assertEquals(xpath.string('//oai:identifier'), u'oai:ham')
+
     def test_list_with_dates(self):
         xml = urllib2.urlopen('http://test?verb=ListIdentifiers'
                               '&metadataPrefix=oai_dc&from=2010-01-01').read()
@@ -510,6 +1465,8 @@ def suite():
     test_suite = TestSuite()
     test_suite.addTest(makeSuite(XPathUtilTest))
     test_suite.addTest(makeSuite(DatabaseTest))
+    test_suite.addTest(makeSuite(LabmanDatabaseTest))
+    test_suite.addTest(makeSuite(ReplicationTest))
     test_suite.addTest(makeSuite(ProviderTest))
     test_suite.addTest(makeSuite(ServerTest))
     # note that tests of the oai protocol itself are done in the
@@ -15,29 +15,9 @@ from moai.database import SQLDatabase
 
 VERSION = pkg_resources.working_set.by_key['moai'].version
                  
-def update_moai():
-    usage = "usage: %prog [options] profilename"
-    version = "%%prog %s" % VERSION
-
-    parser = OptionParser(usage, version=version)
-
-    parser.add_option("-v", "--verbose", dest="verbose",
-                      help="print logging at info level",
-                      action="store_true")
-    parser.add_option('-d', '--debug', dest='debug',
-                      help="print traceback and quit on error",
-                      action='store_true')
-    parser.add_option("-q", "--quiet", dest="quiet",
-                      help="be quiet, do not output and info",
-                      action="store_true")
-    parser.add_option("", "--config", dest="config",
-                      help="specify settings file",
-                      action="store")
-    parser.add_option("", "--date", dest="from_date",
-                      help="Only update database from a specific date",
-                      action="store")
-        
-    options, args = parser.parse_args()
+def get_profile_config(options, args):
+    """Read the settings of the profile named in args from the settings
+    file, exits when the file or profile can not be found."""
     if not len(args):
         profile_name = 'default'
     else:
@@ -74,6 +54,32 @@ def update_moai():
             sys.stderr.write('unknown profile: %s\n' % profile_name)
         sys.stderr.write('(known profiles are: %s)\n' % ', '.join(profiles))
         sys.exit(1)
+    return config
+
+def update_moai():
+    usage = "usage: %prog [options] profilename"
+    version = "%%prog %s" % VERSION
+
+    parser = OptionParser(usage, version=version)
+
+    parser.add_option("-v", "--verbose", dest="verbose",
+                      help="print logging at info level",
+                      action="store_true")
+    parser.add_option('-d', '--debug', dest='debug',
+                      help="print traceback and quit on error",
+                      action='store_true')
+    parser.add_option("-q", "--quiet", dest="quiet",
+                      help="be quiet, do not output and info",
+                      action="store_true")
+    parser.add_option("", "--config", dest="config",
+                      help="specify settings file",
+                      action="store")
+    parser.add_option("", "--date", dest="from_date",
+                      help="Only update database from a specific date",
+                      action="store")
+        
+    options, args = parser.parse_args()
+    config = get_profile_config(options, args)
 
     if options.from_date:
         if 'T' in options.from_date:
@@ -200,3 +206,78 @@ def update_moai():
         if not options.verbose and not options.quiet:
             print >> sys.stderr, msg
 
+
+def index_moai():
+    usage = "usage: %prog [options] profilename"
+    version = "%%prog %s" % VERSION
+
+    parser = OptionParser(usage, version=version)
+
+    parser.add_option("-q", "--quiet", dest="quiet",
+                      help="be quiet, do not output and info",
+                      action="store_true")
+    parser.add_option("", "--config", dest="config",
+                      help="specify settings file",
+                      action="store")
+    parser.add_option("", "--rebuild", dest="rebuild",
+                      help="drop and recompute the admin log rollup "
+                      "and the whole record index",
+                      action="store_true")
+
+    options, args = parser.parse_args()
+    config = get_profile_config(options, args)
+
+    database = SQLDatabase(config['database'], config)
+    starttime = time.time()
+    if options.rebuild:
+        database.rebuild_latest_actions()
+        count = database.rebuild_index()
+        msg = 'Rebuilding record index with %s records took %s'
+    else:
+        database.refresh_latest_actions()
+        count = database.refresh_index()
+        msg = 'Refreshing record index, %s records changed, took %s'
+    if not options.quiet:
+        print >> sys.stderr, msg % (count, get_duration(starttime))
+
+def indexes_moai():
+    usage = "usage: %prog [options] profilename"
+    version = "%%prog %s" % VERSION
+
+    parser = OptionParser(usage, version=version)
+
+    parser.add_option("", "--config", dest="config",
+                      help="specify settings file",
+                      action="store")
+    parser.add_option("", "--create", dest="create",
+                      help="create the missing indexes and show the query "
+                      "plans before and after",
+                      action="store_true")
+
+    options, args = parser.parse_args()
+    config = get_profile_config(options, args)
+
+    database = SQLDatabase(config['database'], config)
+    missing = database.get_missing_indexes()
+    for name, table, columns in missing:
+        print 'missing index %s on %s (%s)' % (name, table, ', '.join(columns))
+    if not missing:
+        print 'all indexes are present'
+    if not options.create or not missing:
+        return
+
+    queries = database.get_hot_queries()
+    before = [database.explain(statement) for description, statement
+              in queries]
+    for name, table, columns in database.create_indexes():
+        print 'created index %s on %s' % (name, table)
+    for (description, statement), plan in zip(queries, before):
+        after = database.explain(statement)
+        if after is None:
+            continue
+        print
+        print description
+        for label, lines in [('before', plan), ('after', after)]:
+            print '  %s:' % label
+            for line in lines:
+                print '    %s' % line
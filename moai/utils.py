@@ -1,6 +1,11 @@
 import sys
+import array
+import bisect
+import struct
+import hashlib
 import datetime
 import time
+import threading
 import logging
 import logging.handlers
 
@@ -216,3 +221,99 @@ class ProgressBar(object):
 
 
 
+
+
+class LRUCache(object):
+    """A bounded mapping that forgets the least recently used keys when it
+    grows beyond size, and counts hits and misses of get. It can be
+    shared by threads."""
+
+    def __init__(self, size=1000):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._items = {}
+        self._clock = 0
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        self._lock.acquire()
+        try:
+            item = self._items.get(key)
+            if item is None:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self._clock += 1
+            item[0] = self._clock
+            return item[1]
+        finally:
+            self._lock.release()
+
+    def set(self, key, value):
+        self._lock.acquire()
+        try:
+            self._clock += 1
+            self._items[key] = [self._clock, value]
+            if len(self._items) > self.size:
+                # evict a quarter at once, so a full cache does not pay
+                # for a scan on every insert
+                used = sorted([(item[0], key)
+                               for key, item in self._items.items()])
+                for clock, key in used[:max(1,
+                                            len(used) - self.size * 3 / 4)]:
+                    del self._items[key]
+        finally:
+            self._lock.release()
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def __len__(self):
+        return len(self._items)
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._items.clear()
+        finally:
+            self._lock.release()
+
+    def stats(self):
+        return {'size': len(self._items),
+                'hits': self.hits,
+                'misses': self.misses}
+
+
+class IdentifierFilter(object):
+    """A compact membership filter over a set of identifiers, stored as a
+    sorted array of 32 bit hashes. An identifier that is not in the
+    filter certainly was not added, one that is in it probably was."""
+
+    def __init__(self, identifiers=()):
+        self._hashes = array.array('I', sorted(set(
+            [self.hash(identifier) for identifier in identifiers])))
+        self.checks = 0
+        self.rejects = 0
+
+    def hash(self, identifier):
+        if isinstance(identifier, unicode):
+            identifier = identifier.encode('utf8')
+        return struct.unpack('<I', hashlib.md5(identifier).digest()[:4])[0]
+
+    def __contains__(self, identifier):
+        self.checks += 1
+        value = self.hash(identifier)
+        index = bisect.bisect_left(self._hashes, value)
+        if index < len(self._hashes) and self._hashes[index] == value:
+            return True
+        self.rejects += 1
+        return False
+
+    def __len__(self):
+        return len(self._hashes)
+
+    def stats(self):
+        return {'size': len(self._hashes),
+                'checks': self.checks,
+                'rejects': self.rejects}
@@ -25,6 +25,8 @@ setup(
     entry_points= {
     'console_scripts': [
         'update_moai = moai.tools:update_moai',
+        'index_moai = moai.tools:index_moai',
+        'indexes_moai = moai.tools:indexes_moai',
       ],
     'paste.app_factory':[
         'main=moai.wsgi:app_factory'